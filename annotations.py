@@ -1,10 +1,14 @@
 import os
-import json
 import uuid
+import threading
+from collections import OrderedDict, defaultdict
 from datetime import datetime
-from typing import List, Optional, Literal, Any
+from typing import List, Optional, Literal, Any, Tuple, Dict
+import msgspec
 from pydantic import BaseModel, Field
 
+from fileio import atomic_write_bytes
+
 # --- Data Models ---
 
 class AnnotationTarget(BaseModel):
@@ -44,73 +48,258 @@ class Annotation(BaseModel):
     target: AnnotationTarget
     content: AnnotationContent
 
+# --- Storage Records ---
+# msgspec mirrors of the models above. The on-disk list is decoded straight into
+# these, so Pydantic validation only runs on the single annotation in a request.
+
+class AnnotationTargetRecord(msgspec.Struct):
+    chapter_index: int
+    cfi: Optional[str] = None
+    quote: Optional[str] = None
+    page_num: Optional[int] = None
+    rect: Optional[List[float]] = None
+    rects: Optional[List[List[float]]] = None
+
+    def __post_init__(self):
+        # Same legacy migration as AnnotationTarget.migrate_rect_to_rects
+        if self.rect and self.rects is None:
+            self.rects = [self.rect]
+
+class ChatMessageRecord(msgspec.Struct):
+    role: str
+    content: str
+
+class AnnotationContentRecord(msgspec.Struct):
+    text: Optional[str] = None
+    color: Optional[str] = None
+    chat_messages: Optional[List[ChatMessageRecord]] = None
+
+class AnnotationRecord(msgspec.Struct, kw_only=True):
+    id: str = msgspec.field(default_factory=lambda: str(uuid.uuid4()))
+    created_at: str = msgspec.field(default_factory=lambda: datetime.utcnow().isoformat())
+    type: Literal['highlight', 'note', 'chat_thread']
+    target: AnnotationTargetRecord
+    content: AnnotationContentRecord
+
+_DECODER = msgspec.json.Decoder(AnnotationRecord)
+_LEGACY_DECODER = msgspec.json.Decoder(List[AnnotationRecord])
+_ENCODER = msgspec.json.Encoder()
+
+def to_record(annotation: Annotation) -> AnnotationRecord:
+    """Converts a validated API model into its storage record."""
+    return msgspec.convert(annotation.model_dump(), AnnotationRecord)
+
+def encode_annotations(annotations: List[AnnotationRecord]) -> bytes:
+    return _ENCODER.encode(annotations)
+
 # --- Storage Logic ---
+# Annotations are stored as JSON Lines (one annotation per line) so that a new
+# highlight is a single append instead of a full rewrite of the file.
+
+# In-memory cache of parsed annotation files, validated against (mtime_ns, size)
+# so edits made outside this process are still picked up. Each entry also keeps
+# an id -> list position map so writers find their target without a scan.
+_CACHE_MAX_BOOKS = 64
+_CACHE: "OrderedDict[str, Tuple[Tuple[int, int], List[AnnotationRecord], Dict[str, int]]]" = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+# Serializes read-modify-write cycles per annotations file
+_WRITE_LOCKS: "defaultdict[str, threading.Lock]" = defaultdict(threading.Lock)
+
+def _stat_key(path: str) -> Tuple[int, int]:
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def _build_index(annotations: List[AnnotationRecord]) -> Dict[str, int]:
+    index = {}
+    for i, a in enumerate(annotations):
+        # First occurrence wins, matching a front-to-back search
+        index.setdefault(a.id, i)
+    return index
+
+def _cache_put(path: str, key: Tuple[int, int], annotations: List[AnnotationRecord],
+               index: Optional[Dict[str, int]] = None):
+    if index is None:
+        index = _build_index(annotations)
+    with _CACHE_LOCK:
+        _CACHE[path] = (key, annotations, index)
+        _CACHE.move_to_end(path)
+        while len(_CACHE) > _CACHE_MAX_BOOKS:
+            _CACHE.popitem(last=False)
+
+def _cache_evict(path: str):
+    with _CACHE_LOCK:
+        _CACHE.pop(path, None)
 
 def _get_annotations_path(books_dir: str, book_id: str) -> str:
+    return os.path.join(books_dir, book_id, "annotations.jsonl")
+
+def _get_legacy_annotations_path(books_dir: str, book_id: str) -> str:
     return os.path.join(books_dir, book_id, "annotations.json")
 
-def load_annotations(books_dir: str, book_id: str) -> List[Annotation]:
+def _decode_lines(buf: bytes, book_id: str) -> List[AnnotationRecord]:
+    try:
+        return _DECODER.decode_lines(buf)
+    except msgspec.DecodeError:
+        # A torn trailing line (e.g. crash mid-append) shouldn't lose the rest
+        annotations = []
+        for line in buf.splitlines():
+            if not line.strip():
+                continue
+            try:
+                annotations.append(_DECODER.decode(line))
+            except msgspec.DecodeError as e:
+                print(f"Skipping corrupt annotation line for {book_id}: {e}")
+        return annotations
+
+def _rewrite_annotations(path: str, annotations: List[AnnotationRecord]):
+    atomic_write_bytes(path, _ENCODER.encode_lines(annotations))
+
+def migrate_legacy_annotations(books_dir: str, book_id: str) -> bool:
+    """One-time migration: convert a book's annotations.json list into annotations.jsonl."""
+    legacy_path = _get_legacy_annotations_path(books_dir, book_id)
     path = _get_annotations_path(books_dir, book_id)
-    if not os.path.exists(path):
-        return []
-    
+    if not os.path.exists(legacy_path) or os.path.exists(path):
+        return False
+
+    with open(legacy_path, "rb") as f:
+        annotations = _LEGACY_DECODER.decode(f.read())
+    _rewrite_annotations(path, annotations)
+    os.rename(legacy_path, legacy_path + ".bak")
+    return True
+
+def migrate_all_annotations(books_dir: str):
+    """Runs migrate_legacy_annotations for every book folder."""
+    if not os.path.exists(books_dir):
+        return
+    # DirEntry.is_dir() uses the type from readdir, no extra stat per entry
+    with os.scandir(books_dir) as it:
+        for entry in it:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            try:
+                if migrate_legacy_annotations(books_dir, entry.name):
+                    print(f"  Migrated annotations for: {entry.name}")
+            except Exception as e:
+                print(f"Error migrating annotations for {entry.name}: {e}")
+
+def _load_cached(books_dir: str, book_id: str) -> Tuple[List[AnnotationRecord], Dict[str, int]]:
+    """
+    Returns the cached list and its id -> index map themselves;
+    writers mutate them in place while holding the book's lock.
+    """
+    path = _get_annotations_path(books_dir, book_id)
+    # Books added after startup may still carry the old format
+    migrate_legacy_annotations(books_dir, book_id)
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            raw_data = json.load(f)
-            return [Annotation(**item) for item in raw_data]
+        key = _stat_key(path)
+    except FileNotFoundError:
+        _cache_evict(path)
+        return [], {}
+
+    with _CACHE_LOCK:
+        entry = _CACHE.get(path)
+        if entry is not None and entry[0] == key:
+            _CACHE.move_to_end(path)
+            return entry[1], entry[2]
+
+    with open(path, "rb") as f:
+        annotations = _decode_lines(f.read(), book_id)
+    index = _build_index(annotations)
+    _cache_put(path, key, annotations, index)
+    return annotations, index
+
+def _replace_locked(path: str, annotations: List[AnnotationRecord],
+                    index: Optional[Dict[str, int]] = None):
+    """Rewrites the file and cache entry; caller must hold the file's write lock."""
+    try:
+        _rewrite_annotations(path, annotations)
+        _cache_put(path, _stat_key(path), annotations, index)
+    except Exception:
+        _cache_evict(path)
+        raise
+
+def load_annotations(books_dir: str, book_id: str) -> List[AnnotationRecord]:
+    try:
+        return list(_load_cached(books_dir, book_id)[0])
     except Exception as e:
         print(f"Error loading annotations for {book_id}: {e}")
         return []
 
-def save_annotation_to_disk(books_dir: str, book_id: str, new_annotation: Annotation):
-    # Load existing
-    annotations = load_annotations(books_dir, book_id)
-    annotations.append(new_annotation)
-    
-    # Save back
+def save_annotation_to_disk(books_dir: str, book_id: str, new_annotation: AnnotationRecord):
     path = _get_annotations_path(books_dir, book_id)
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    try:
-        with open(path, "w", encoding="utf-8") as f:
-            # dumping model_dump(mode='json') handles datetime/uuid serialization
-            json.dump([a.model_dump(mode='json') for a in annotations], f, indent=2)
-    except Exception as e:
-        print(f"Error saving annotation for {book_id}: {e}")
-        raise e
+    with _WRITE_LOCKS[path]:
+        try:
+            annotations, index = _load_cached(books_dir, book_id)
+            # Append only: O(1) bytes written regardless of existing annotations
+            with open(path, "ab") as f:
+                f.write(_ENCODER.encode(new_annotation) + b"\n")
+            annotations.append(new_annotation)
+            index.setdefault(new_annotation.id, len(annotations) - 1)
+            _cache_put(path, _stat_key(path), annotations, index)
+        except Exception as e:
+            _cache_evict(path)
+            print(f"Error saving annotation for {book_id}: {e}")
+            raise e
 
 def delete_annotation_from_disk(books_dir: str, book_id: str, annotation_id: str):
-    annotations = load_annotations(books_dir, book_id)
-    filtered = [a for a in annotations if a.id != annotation_id]
-    
-    if len(filtered) == len(annotations):
-        return False # ID not found
-    
     path = _get_annotations_path(books_dir, book_id)
-    try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump([a.model_dump(mode='json') for a in filtered], f, indent=2)
-        return True
-    except Exception as e:
-        print(f"Error deleting annotation for {book_id}: {e}")
-        raise e
+    with _WRITE_LOCKS[path]:
+        annotations, index = _load_cached(books_dir, book_id)
+        if annotation_id not in index:
+            return False # ID not found
 
-def update_annotation_in_disk(books_dir: str, book_id: str, updated_annotation: Annotation):
-    annotations = load_annotations(books_dir, book_id)
-    found = False
-    for i, a in enumerate(annotations):
-        if a.id == updated_annotation.id:
-            annotations[i] = updated_annotation
-            found = True
-            break
-    
-    if not found:
-        return False
+        # Positions after the removed entry shift, so the index is rebuilt from the new list
+        filtered = [a for a in annotations if a.id != annotation_id]
 
+        try:
+            _replace_locked(path, filtered)
+            return True
+        except Exception as e:
+            print(f"Error deleting annotation for {book_id}: {e}")
+            raise e
+
+def update_annotation_in_disk(books_dir: str, book_id: str, updated_annotation: AnnotationRecord):
     path = _get_annotations_path(books_dir, book_id)
-    try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump([a.model_dump(mode='json') for a in annotations], f, indent=2)
-        return True
-    except Exception as e:
-        print(f"Error updating annotation for {book_id}: {e}")
-        raise e
+    with _WRITE_LOCKS[path]:
+        annotations, index = _load_cached(books_dir, book_id)
+        i = index.get(updated_annotation.id)
+        if i is None:
+            return False
+        annotations[i] = updated_annotation
+
+        try:
+            _replace_locked(path, annotations, index)
+            return True
+        except Exception as e:
+            print(f"Error updating annotation for {book_id}: {e}")
+            raise e
+
+def append_chat_to_annotation(books_dir: str, book_id: str, annotation_id: str, message: ChatMessageRecord) -> bool:
+    """
+    Appends a message to an annotation's chat thread as one locked read-modify-write,
+    so concurrent chat requests on the same book can't drop each other's messages.
+    """
+    path = _get_annotations_path(books_dir, book_id)
+    with _WRITE_LOCKS[path]:
+        annotations, index = _load_cached(books_dir, book_id)
+        i = index.get(annotation_id)
+        if i is None:
+            return False
+        target = annotations[i]
+
+        # Ensure chat_messages list exists
+        if target.content.chat_messages is None:
+            target.content.chat_messages = []
+        target.content.chat_messages.append(message)
+
+        # A highlight that gets a reply becomes a chat thread
+        if target.type == 'highlight':
+            target.type = 'chat_thread'
+
+        try:
+            _replace_locked(path, annotations, index)
+            return True
+        except Exception as e:
+            print(f"Error saving annotations for {book_id}: {e}")
+            raise e
@@ -0,0 +1,21 @@
+import os
+import threading
+
+def atomic_write_bytes(path: str, buf: bytes):
+    """
+    Writes buf to a temp file, fsyncs it and os.replace()s it over path,
+    so a crash or a concurrent reader never sees a truncated file.
+    """
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -3,18 +3,22 @@ Parses an EPUB file into a structured object that can be used to serve the book
 """
 
 import os
+import mmap
 import pickle
 import shutil
 from dataclasses import dataclass, field
 from typing import List, Dict, Optional, Any
 from datetime import datetime
-from urllib.parse import unquote
+from urllib.parse import quote, unquote
 
+import msgspec
 import ebooklib
 from ebooklib import epub
 from bs4 import BeautifulSoup, Comment
 import fitz # PyMuPDF
 
+from fileio import atomic_write_bytes
+
 # --- Data structures ---
 
 @dataclass
@@ -68,6 +72,28 @@ class Book:
     version: str = "3.0"
 
 
+@dataclass
+class SpineEntry:
+    """A spine item without its content, as stored in meta.json."""
+    id: str
+    href: str
+    title: str
+    order: int
+
+
+@dataclass
+class BookIndex:
+    """
+    Everything the reader needs except the chapter bodies (meta.json).
+    Chapter HTML lives in chapters/{index}.html and is read on demand.
+    """
+    metadata: BookMetadata
+    spine: List[SpineEntry]
+    toc: List[TOCEntry]
+    source_file: str
+    version: str = "3.0"
+
+
 # --- Utilities ---
 
 def clean_html_content(soup: BeautifulSoup) -> BeautifulSoup:
@@ -190,7 +216,9 @@ def process_epub(epub_path: str, output_dir: str) -> Book:
 
     # 4. Extract Images & Build Map
     print("Extracting images...")
-    image_map = {} # Key: internal_path, Value: local_relative_path
+    image_map = {} # Key: internal_path, Value: URL under the /books static mount
+    # Absolute URLs let the static mount serve images without going through a handler
+    image_url_prefix = f"/books/{quote(os.path.basename(os.path.normpath(output_dir)))}/images/"
 
     for item in book.get_items():
         if item.get_type() == ebooklib.ITEM_IMAGE:
@@ -206,7 +234,7 @@ def process_epub(epub_path: str, output_dir: str) -> Book:
 
             # Map keys: We try both the full internal path and just the basename
             # to be robust against messy HTML src attributes
-            rel_path = f"images/{safe_fname}"
+            rel_path = image_url_prefix + quote(safe_fname)
             image_map[item.get_name()] = rel_path
             image_map[original_fname] = rel_path
 
@@ -337,6 +365,59 @@ def save_to_pickle(book: Book, output_dir: str):
     print(f"Saved structured data to {p_path}")
 
 
+def save_to_msgpack(book: Book, output_dir: str):
+    """
+    Writes book.msgpack next to book.pkl.
+    Decoding it is much cheaper than unpickling, so the server prefers it.
+    Written atomically: the server may upgrade a book while it is being read.
+    """
+    m_path = os.path.join(output_dir, 'book.msgpack')
+    atomic_write_bytes(m_path, msgspec.msgpack.encode(book))
+    print(f"Saved structured data to {m_path}")
+
+
+_BOOK_DECODER = msgspec.msgpack.Decoder(Book)
+_INDEX_DECODER = msgspec.json.Decoder(BookIndex)
+
+
+def load_from_msgpack(m_path: str) -> Book:
+    """Decodes book.msgpack straight from a read-only mmap of the file."""
+    with open(m_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _BOOK_DECODER.decode(mm)
+
+
+def make_book_index(book: Book) -> BookIndex:
+    return BookIndex(
+        metadata=book.metadata,
+        spine=[SpineEntry(id=c.id, href=c.href, title=c.title, order=c.order) for c in book.spine],
+        toc=book.toc,
+        source_file=book.source_file,
+        version=book.version
+    )
+
+
+def save_split_layout(book: Book, output_dir: str):
+    """
+    Writes meta.json plus one chapters/{index}.html per spine item,
+    so the server can serve a chapter without loading the whole book.
+    Each file is replaced atomically, so live readers never see a partial one.
+    """
+    chapters_dir = os.path.join(output_dir, 'chapters')
+    os.makedirs(chapters_dir, exist_ok=True)
+    for i, chapter in enumerate(book.spine):
+        atomic_write_bytes(os.path.join(chapters_dir, f"{i}.html"), chapter.content.encode('utf-8'))
+
+    # meta.json last: its presence marks the split layout as complete
+    atomic_write_bytes(os.path.join(output_dir, 'meta.json'), msgspec.json.encode(make_book_index(book)))
+    print(f"Saved split layout to {output_dir}")
+
+
+def load_book_index(meta_path: str) -> BookIndex:
+    with open(meta_path, 'rb') as f:
+        return _INDEX_DECODER.decode(f.read())
+
+
 # --- CLI ---
 
 if __name__ == "__main__":
@@ -362,6 +443,8 @@ if __name__ == "__main__":
     else:
         book_obj = process_epub(epub_file, out_dir)
     save_to_pickle(book_obj, out_dir)
+    save_to_msgpack(book_obj, out_dir)
+    save_split_layout(book_obj, out_dir)
     print("\n--- Summary ---")
     print(f"Title: {book_obj.metadata.title}")
     print(f"Authors: {', '.join(book_obj.metadata.authors)}")
@@ -1,20 +1,32 @@
 import os
+import time
+import asyncio
 import pickle
-from functools import lru_cache
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from urllib.parse import quote
 from typing import Optional
 
-from fastapi import FastAPI, Request, HTTPException, Body
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import HTMLResponse, ORJSONResponse, RedirectResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import httpx
+import orjson
 import os
 import signal
 import sys
 
-from reader3 import Book, BookMetadata, ChapterContent, TOCEntry
+from fileio import atomic_write_bytes
+from reader3 import (
+    Book, BookIndex, BookMetadata, ChapterContent, TOCEntry,
+    load_from_msgpack, save_to_msgpack, load_book_index, make_book_index, save_split_layout
+)
 import json
-from typing import List
+from typing import List, Literal
 from pydantic import BaseModel
 
 class ProgressUpdate(BaseModel):
@@ -28,31 +40,215 @@ class ChatMessage(BaseModel):
     role: str
     content: str
 
-app = FastAPI()
+class ChatProxyPayload(BaseModel):
+    provider: Literal['openai', 'anthropic', 'custom']
+    apiKey: Optional[str] = None
+    baseUrl: Optional[str] = None
+    model: Optional[str] = None
+    messages: List[dict]
+    stream: bool = False  # True relays the provider's SSE stream as it arrives
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client for chat_proxy, so chat calls reuse upstream TCP/TLS connections
+    app.state.http = httpx.AsyncClient(
+        timeout=60.0,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        http2=True
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        # Let writes already running in worker threads finish before the DB closes
+        if app.state.progress_writes:
+            await asyncio.gather(*list(app.state.progress_writes), return_exceptions=True)
+        flush_pending_progress()
+        close_progress_db()
+
+# orjson encodes every JSON response (chapter HTML included) in C instead of stdlib json
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+# Debounced progress writes: latest snapshot per book + its scheduled flush
+app.state.pending_progress = {}
+app.state.progress_timers = {}
+app.state.progress_writes = set()  # flushes handed to worker threads, not yet done
 app.mount("/books", StaticFiles(directory="books"), name="books")
 templates = Jinja2Templates(directory="templates")
 
 # Where are the book folders located?
 BOOKS_DIR = "books"
 
-@lru_cache(maxsize=10)
-def load_book_cached(folder_name: str) -> Optional[Book]:
-    """
-    Loads the book from the pickle file.
-    Cached so we don't re-read the disk on every click.
-    """
-    file_path = os.path.join(BOOKS_DIR, folder_name, "book.pkl")
+# Loaded books keyed by book dir: (stat key, size estimate, last used, Book).
+# Entries are revalidated against the file on every hit, idle ones expire
+# after BOOK_CACHE_TTL, and the total is capped by count and by bytes.
+BOOK_CACHE_MAX_BOOKS = 10
+BOOK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+BOOK_CACHE_TTL = 600.0
+_book_cache = OrderedDict()
+_book_cache_lock = threading.Lock()
+
+def _book_stat(book_dir: str):
+    """(path, mtime_ns, size) of the file the book would be loaded from, or None."""
+    for name in ("book.msgpack", "book.pkl"):
+        path = os.path.join(book_dir, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        return path, st.st_mtime_ns, st.st_size
+    return None
+
+def _read_book(book_dir: str, folder_name: str) -> Optional[Book]:
+    msgpack_path = os.path.join(book_dir, "book.msgpack")
+    if os.path.exists(msgpack_path):
+        try:
+            return load_from_msgpack(msgpack_path)
+        except Exception as e:
+            print(f"Error loading {msgpack_path}, falling back to pickle: {e}")
+
+    file_path = os.path.join(book_dir, "book.pkl")
     if not os.path.exists(file_path):
         return None
 
     try:
         with open(file_path, "rb") as f:
             book = pickle.load(f)
-        return book
     except Exception as e:
         print(f"Error loading book {folder_name}: {e}")
         return None
 
+    # Upgrade books imported before book.msgpack existed
+    try:
+        save_to_msgpack(book, book_dir)
+    except Exception as e:
+        print(f"Could not write book.msgpack for {folder_name}: {e}")
+    return book
+
+def _evict_books(now: float):
+    """Drops expired entries, then least recently used ones until under both caps."""
+    for key in [k for k, v in _book_cache.items() if now - v[2] > BOOK_CACHE_TTL]:
+        del _book_cache[key]
+    total = sum(v[1] for v in _book_cache.values())
+    while _book_cache and (len(_book_cache) > BOOK_CACHE_MAX_BOOKS or total > BOOK_CACHE_MAX_BYTES):
+        _, entry = _book_cache.popitem(last=False)
+        total -= entry[1]
+
+def load_book_cached(folder_name: str) -> Optional[Book]:
+    """
+    Loads the book from book.msgpack, falling back to the legacy pickle file.
+    Cached so we don't re-read the disk on every click; a re-imported book
+    (new mtime or size) is picked up on the next request.
+    """
+    book_dir = os.path.join(BOOKS_DIR, folder_name)
+    stat = _book_stat(book_dir)
+    if stat is None:
+        with _book_cache_lock:
+            _book_cache.pop(book_dir, None)
+        return None
+
+    now = time.monotonic()
+    with _book_cache_lock:
+        entry = _book_cache.get(book_dir)
+        if entry is not None and entry[0] == stat:
+            _book_cache[book_dir] = (entry[0], entry[1], now, entry[3])
+            _book_cache.move_to_end(book_dir)
+            return entry[3]
+
+    book = _read_book(book_dir, folder_name)
+    if book is None:
+        return None
+
+    # Stat again: loading a pickle-only book writes book.msgpack
+    stat = _book_stat(book_dir) or stat
+    with _book_cache_lock:
+        # On-disk size is a cheap stand-in for the unpickled footprint
+        _book_cache[book_dir] = (stat, stat[2], now, book)
+        _book_cache.move_to_end(book_dir)
+        _evict_books(now)
+    return book
+
+def _clear_book_cache():
+    with _book_cache_lock:
+        _book_cache.clear()
+
+load_book_cached.cache_clear = _clear_book_cache
+
+# Parsed meta.json keyed by book dir: (stat key, BookIndex). Revalidated against
+# meta.json on every hit like _book_cache; misses are never cached.
+METADATA_CACHE_MAX_BOOKS = 64
+_metadata_cache = OrderedDict()
+_metadata_cache_lock = threading.Lock()
+
+def _meta_stat(meta_path: str):
+    """(mtime_ns, size) of meta.json, or None if it doesn't exist."""
+    try:
+        st = os.stat(meta_path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def load_metadata_cached(folder_name: str) -> Optional[BookIndex]:
+    """
+    Loads only meta.json (metadata, TOC, spine without content).
+    Hot endpoints use this plus load_chapter_html instead of the whole book;
+    a re-imported book (new meta.json) is picked up on the next request.
+    """
+    book_dir = os.path.join(BOOKS_DIR, folder_name)
+    meta_path = os.path.join(book_dir, "meta.json")
+    stat = _meta_stat(meta_path)
+    if stat is None:
+        with _metadata_cache_lock:
+            _metadata_cache.pop(book_dir, None)
+        # Books imported before the split layout: convert once from the full book
+        book = load_book_cached(folder_name)
+        if not book:
+            return None
+        try:
+            save_split_layout(book, book_dir)
+        except Exception as e:
+            print(f"Could not write split layout for {folder_name}: {e}")
+            return make_book_index(book)
+        stat = _meta_stat(meta_path)
+        if stat is None:
+            return make_book_index(book)
+
+    with _metadata_cache_lock:
+        entry = _metadata_cache.get(book_dir)
+        if entry is not None and entry[0] == stat:
+            _metadata_cache.move_to_end(book_dir)
+            return entry[1]
+
+    try:
+        index = load_book_index(meta_path)
+    except Exception as e:
+        print(f"Error loading metadata for {folder_name}: {e}")
+        return None
+
+    with _metadata_cache_lock:
+        _metadata_cache[book_dir] = (stat, index)
+        _metadata_cache.move_to_end(book_dir)
+        while len(_metadata_cache) > METADATA_CACHE_MAX_BOOKS:
+            _metadata_cache.popitem(last=False)
+    return index
+
+def _clear_metadata_cache():
+    with _metadata_cache_lock:
+        _metadata_cache.clear()
+
+load_metadata_cached.cache_clear = _clear_metadata_cache
+
+def load_chapter_html(folder_name: str, chapter_index: int) -> Optional[str]:
+    """Reads a single chapter body from chapters/{index}.html."""
+    path = os.path.join(BOOKS_DIR, folder_name, "chapters", f"{chapter_index}.html")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        book = load_book_cached(folder_name)
+        if not book or chapter_index >= len(book.spine):
+            return None
+        return book.spine[chapter_index].content
+
 OLD_PROGRESS_FILE = "reading_progress.json"
 
 # --- Per-book storage helpers ---
@@ -60,60 +256,158 @@ OLD_PROGRESS_FILE = "reading_progress.json"
 def _book_dir(book_id: str) -> str:
     return os.path.join(BOOKS_DIR, book_id)
 
+# Reading progress lives in one WAL-mode SQLite file per books dir instead of a
+# progress.json per book: a save is a single row upsert + WAL append.
+
+PROGRESS_DB_FILE = "progress.db"
+_progress_conns: dict = {}  # books_dir -> sqlite3.Connection
+_progress_lock = threading.Lock()
+
+def _progress_db() -> sqlite3.Connection:
+    """Returns the progress DB for the current BOOKS_DIR; caller must hold _progress_lock."""
+    conn = _progress_conns.get(BOOKS_DIR)
+    if conn is None:
+        os.makedirs(BOOKS_DIR, exist_ok=True)
+        conn = sqlite3.connect(
+            os.path.join(BOOKS_DIR, PROGRESS_DB_FILE),
+            isolation_level=None,  # autocommit; batches use explicit transactions
+            check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS progress (book_id TEXT PRIMARY KEY, data BLOB NOT NULL)")
+        _progress_conns[BOOKS_DIR] = conn
+    return conn
+
+def close_progress_db():
+    with _progress_lock:
+        for conn in _progress_conns.values():
+            conn.close()
+        _progress_conns.clear()
+
 def load_progress(book_id: str) -> dict:
-    path = os.path.join(_book_dir(book_id), "progress.json")
-    if not os.path.exists(path):
-        return {}
+    # A queued (not yet flushed) snapshot is the most recent one
+    pending = app.state.pending_progress.get(book_id)
+    if pending is not None:
+        return dict(pending)
     try:
-        with open(path, "r") as f:
-            return json.load(f)
+        with _progress_lock:
+            row = _progress_db().execute(
+                "SELECT data FROM progress WHERE book_id = ?", (book_id,)
+            ).fetchone()
+        return orjson.loads(row[0]) if row else {}
     except Exception as e:
         print(f"Error loading progress for {book_id}: {e}")
         return {}
 
 def save_progress_helper(book_id: str, data: dict):
-    d = _book_dir(book_id)
-    os.makedirs(d, exist_ok=True)
-    path = os.path.join(d, "progress.json")
-    with open(path, "w") as f:
-        json.dump(data, f, indent=2)
+    with _progress_lock:
+        _progress_db().execute(
+            "INSERT OR REPLACE INTO progress (book_id, data) VALUES (?, ?)",
+            (book_id, orjson.dumps(data))
+        )
+
+def migrate_progress_files():
+    """One-time migration: move per-book progress.json files into the progress DB."""
+    if not os.path.exists(BOOKS_DIR):
+        return
+    rows = []
+    migrated = []
+    with os.scandir(BOOKS_DIR) as it:
+        for entry in it:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            path = os.path.join(entry.path, "progress.json")
+            try:
+                with open(path, "rb") as f:
+                    data = orjson.loads(f.read())
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                print(f"Error reading {path}: {e}")
+                continue
+            rows.append((entry.name, orjson.dumps(data)))
+            migrated.append(path)
+    if not rows:
+        return
+
+    try:
+        with _progress_lock:
+            conn = _progress_db()
+            conn.execute("BEGIN")
+            # Rows written since (e.g. by a newer server) win over old files
+            conn.executemany("INSERT OR IGNORE INTO progress (book_id, data) VALUES (?, ?)", rows)
+            conn.execute("COMMIT")
+        for path in migrated:
+            os.rename(path, path + ".bak")
+        print(f"  Migrated {len(rows)} progress file(s) into {PROGRESS_DB_FILE}")
+    except Exception as e:
+        print(f"Error during progress file migration: {e}")
+
+# Chat history is JSON Lines: appending a message never rewrites earlier ones.
+
+def _chat_history_path(book_id: str) -> str:
+    return os.path.join(_book_dir(book_id), "chat_history.jsonl")
+
+def _migrate_chat_history(book_id: str):
+    """One-time migration: convert a book's chat_history.json list into JSON Lines."""
+    legacy_path = os.path.join(_book_dir(book_id), "chat_history.json")
+    path = _chat_history_path(book_id)
+    if not os.path.exists(legacy_path) or os.path.exists(path):
+        return
+    with open(legacy_path, "rb") as f:
+        messages = orjson.loads(f.read())
+    atomic_write_bytes(path, b"".join(orjson.dumps(m) + b"\n" for m in messages))
+    os.rename(legacy_path, legacy_path + ".bak")
 
 def load_chat_history(book_id: str) -> list:
-    path = os.path.join(_book_dir(book_id), "chat_history.json")
-    if not os.path.exists(path):
-        return []
+    path = _chat_history_path(book_id)
     try:
-        with open(path, "r") as f:
-            return json.load(f)
+        _migrate_chat_history(book_id)
+        if not os.path.exists(path):
+            return []
+        messages = []
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    messages.append(orjson.loads(line))
+                except orjson.JSONDecodeError as e:
+                    # e.g. a torn last line after a crash; keep the rest
+                    print(f"Skipping corrupt chat history line for {book_id}: {e}")
+        return messages
     except Exception as e:
         print(f"Error loading chat history for {book_id}: {e}")
         return []
 
-def save_chat_history(book_id: str, messages: list):
+def append_chat_history(book_id: str, message: dict):
     d = _book_dir(book_id)
     os.makedirs(d, exist_ok=True)
-    path = os.path.join(d, "chat_history.json")
-    with open(path, "w") as f:
-        json.dump(messages, f, indent=2)
+    _migrate_chat_history(book_id)
+    with open(_chat_history_path(book_id), "ab") as f:
+        f.write(orjson.dumps(message) + b"\n")
 
 def delete_chat_history(book_id: str):
-    path = os.path.join(_book_dir(book_id), "chat_history.json")
+    path = _chat_history_path(book_id)
     if os.path.exists(path):
         os.remove(path)
 
 def migrate_global_progress():
-    """One-time migration: split global reading_progress.json into per-book files."""
+    """One-time migration: split global reading_progress.json into per-book progress rows."""
     if not os.path.exists(OLD_PROGRESS_FILE):
         return
     try:
-        with open(OLD_PROGRESS_FILE, "r") as f:
-            all_data = json.load(f)
-        for book_id, data in all_data.items():
-            # Only migrate if per-book file doesn't already exist
-            per_book_path = os.path.join(_book_dir(book_id), "progress.json")
-            if not os.path.exists(per_book_path):
-                save_progress_helper(book_id, data)
-                print(f"  Migrated progress for: {book_id}")
+        with open(OLD_PROGRESS_FILE, "rb") as f:
+            all_data = orjson.loads(f.read())
+        rows = [(book_id, orjson.dumps(data)) for book_id, data in all_data.items()]
+        with _progress_lock:
+            conn = _progress_db()
+            # One transaction for all books; books that already have progress keep it
+            conn.execute("BEGIN")
+            conn.executemany("INSERT OR IGNORE INTO progress (book_id, data) VALUES (?, ?)", rows)
+            conn.execute("COMMIT")
+        print(f"  Migrated progress for {len(rows)} book(s)")
         # Rename old file to .bak
         os.rename(OLD_PROGRESS_FILE, OLD_PROGRESS_FILE + ".bak")
         print(f"Migration complete. Old file renamed to {OLD_PROGRESS_FILE}.bak")
@@ -122,49 +416,91 @@ def migrate_global_progress():
 
 # Run migration on module load
 print("Checking for progress migration...")
+migrate_progress_files()
 migrate_global_progress()
 
+PROGRESS_FLUSH_DELAY = 1.0  # seconds; at most one progress write per book per interval
+
+def _schedule_flush(book_id: str):
+    # Runs on the event loop: timers and pending snapshots are only ever
+    # touched on this thread; the SQLite write itself goes to a worker thread
+    app.state.progress_timers.pop(book_id, None)
+    data = app.state.pending_progress.get(book_id)
+    if data is None:
+        return
+    fut = asyncio.get_running_loop().run_in_executor(None, _write_progress, book_id, data)
+    app.state.progress_writes.add(fut)
+    fut.add_done_callback(lambda f: _write_done(f, book_id, data))
+
+def _write_progress(book_id: str, data: dict):
+    try:
+        save_progress_helper(book_id, data)
+    except Exception as e:
+        print(f"Error saving progress for {book_id}: {e}")
+
+def _write_done(fut, book_id: str, data: dict):
+    # Back on the event loop; keep the snapshot if a newer one arrived meanwhile
+    app.state.progress_writes.discard(fut)
+    if app.state.pending_progress.get(book_id) is data:
+        del app.state.pending_progress[book_id]
+
+def flush_pending_progress():
+    """Writes out every queued progress snapshot now (used on shutdown)."""
+    for timer in list(app.state.progress_timers.values()):
+        timer.cancel()
+    app.state.progress_timers.clear()
+    for book_id, data in list(app.state.pending_progress.items()):
+        _write_progress(book_id, data)
+    app.state.pending_progress.clear()
+
 @app.post("/api/progress/{book_id}")
 async def save_progress(book_id: str, update: ProgressUpdate):
-    data = update.model_dump()
-    save_progress_helper(book_id, data)
-    return {"status": "ok"}
+    # Scroll/zoom fire many updates per second; only the latest one needs to hit disk
+    app.state.pending_progress[book_id] = update.model_dump()
+    if book_id not in app.state.progress_timers:
+        loop = asyncio.get_running_loop()
+        app.state.progress_timers[book_id] = loop.call_later(PROGRESS_FLUSH_DELAY, _schedule_flush, book_id)
+    return {"status": "queued"}
 
 @app.get("/api/chat-history/{book_id}")
 async def get_chat_history(book_id: str):
-    messages = load_chat_history(book_id)
-    return JSONResponse(messages)
+    messages = await asyncio.to_thread(load_chat_history, book_id)
+    return messages
 
 @app.post("/api/chat-history/{book_id}")
 async def append_chat_message(book_id: str, message: ChatMessage):
-    messages = load_chat_history(book_id)
-    messages.append(message.model_dump())
-    save_chat_history(book_id, messages)
+    await asyncio.to_thread(append_chat_history, book_id, message.model_dump())
     return {"status": "ok"}
 
 @app.delete("/api/chat-history/{book_id}")
 async def clear_chat_history(book_id: str):
-    delete_chat_history(book_id)
+    await asyncio.to_thread(delete_chat_history, book_id)
     return {"status": "ok"}
 
 # --- Annotations API ---
 
 from annotations import (
     Annotation, AnnotationContent, AnnotationTarget, ChatMessage,
+    ChatMessageRecord, to_record, encode_annotations, migrate_all_annotations,
     load_annotations, save_annotation_to_disk, 
-    delete_annotation_from_disk, update_annotation_in_disk
+    delete_annotation_from_disk, update_annotation_in_disk, append_chat_to_annotation
 )
 
+print("Checking for annotations migration...")
+migrate_all_annotations(BOOKS_DIR)
+
 @app.get("/api/annotations/{book_id}")
 async def get_annotations(book_id: str):
-    return load_annotations(BOOKS_DIR, book_id)
+    # Records are encoded by msgspec directly, skipping FastAPI's jsonable_encoder
+    annotations = await asyncio.to_thread(load_annotations, BOOKS_DIR, book_id)
+    return Response(content=encode_annotations(annotations), media_type="application/json")
 
 @app.post("/api/annotations/{book_id}")
 async def create_annotation(book_id: str, annotation: Annotation):
     # Ensure ID is unique (it's UUID so unlikely to collide but good practice)
     # save_annotation_to_disk simply appends
     try:
-        save_annotation_to_disk(BOOKS_DIR, book_id, annotation)
+        await asyncio.to_thread(save_annotation_to_disk, BOOKS_DIR, book_id, to_record(annotation))
         return {"status": "ok", "id": annotation.id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -172,7 +508,7 @@ async def create_annotation(book_id: str, annotation: Annotation):
 @app.delete("/api/annotations/{book_id}/{annotation_id}")
 async def delete_annotation(book_id: str, annotation_id: str):
     try:
-        found = delete_annotation_from_disk(BOOKS_DIR, book_id, annotation_id)
+        found = await asyncio.to_thread(delete_annotation_from_disk, BOOKS_DIR, book_id, annotation_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -187,7 +523,7 @@ async def update_annotation(book_id: str, annotation_id: str, annotation: Annota
         raise HTTPException(status_code=400, detail="ID mismatch")
         
     try:
-        found = update_annotation_in_disk(BOOKS_DIR, book_id, annotation)
+        found = await asyncio.to_thread(update_annotation_in_disk, BOOKS_DIR, book_id, to_record(annotation))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
         
@@ -201,65 +537,103 @@ async def append_annotation_chat(book_id: str, annotation_id: str, message: Chat
     Appends a new message to an existing annotation's chat thread.
     Use this for context-aware chatting.
     """
-    annotations = load_annotations(BOOKS_DIR, book_id)
-    target_annotation = None
-    for a in annotations:
-        if a.id == annotation_id:
-            target_annotation = a
-            break
-            
-    if not target_annotation:
+    record = ChatMessageRecord(role=message.role, content=message.content)
+    try:
+        found = await asyncio.to_thread(
+            append_chat_to_annotation, BOOKS_DIR, book_id, annotation_id, record
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if not found:
         raise HTTPException(status_code=404, detail="Annotation not found")
-        
-    # Ensure chat_messages list exists
-    if target_annotation.content.chat_messages is None:
-        target_annotation.content.chat_messages = []
-        
-    target_annotation.content.chat_messages.append(message)
-    
-    # Update type if it was just a highlight before?
-    # Maybe strict typing matters, but for now we just save content.
-    if target_annotation.type == 'highlight':
-         target_annotation.type = 'chat_thread'
+    return {"status": "ok"}
+
+# --- Library index ---
+# books/_index.json caches the library listing; a row is rebuilt only when its
+# folder's mtime changes. The whole listing is also held in memory briefly.
 
+LIBRARY_INDEX_FILE = "_index.json"
+LIBRARY_CACHE_TTL = 5.0  # seconds
+_library_cache: dict = {}  # books_dir -> (expires_at, books)
+
+def _library_row(folder_name: str, book_dir: str) -> Optional[dict]:
     try:
-        update_annotation_in_disk(BOOKS_DIR, book_id, target_annotation)
-        return {"status": "ok"}
+        book = load_metadata_cached(folder_name)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        print(f"Error indexing {folder_name}: {e}")
+        return None
+    if not book:
+        return None
+    return {
+        "title": book.metadata.title,
+        "author": ", ".join(book.metadata.authors),
+        "chapters": len(book.spine),
+        "source_file": book.source_file,
+    }
+
+def load_library_index() -> List[dict]:
+    """Returns the library listing, refreshing only rows whose folder changed."""
+    now = time.monotonic()
+    cached = _library_cache.get(BOOKS_DIR)
+    if cached and now < cached[0]:
+        return cached[1]
+
+    if not os.path.exists(BOOKS_DIR):
+        return []
+
+    index_path = os.path.join(BOOKS_DIR, LIBRARY_INDEX_FILE)
+    try:
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        index = {}
+
+    new_index = {}
+    changed = False
+    # Scan directory for folders ending in '_data'
+    with os.scandir(BOOKS_DIR) as it:
+        for entry in it:
+            # Name check first: no stat for files like progress or the index itself
+            if not entry.name.endswith("_data") or not entry.is_dir(follow_symlinks=False):
+                continue
+            mtime_ns = entry.stat(follow_symlinks=False).st_mtime_ns
+            row = index.get(entry.name)
+            if row is None or row.get("mtime_ns") != mtime_ns:
+                row = _library_row(entry.name, entry.path)
+                if row is None:
+                    continue
+                # Re-stat: indexing an old book may have just written its split layout
+                row["mtime_ns"] = os.stat(entry.path).st_mtime_ns
+                changed = True
+            new_index[entry.name] = row
+
+    if changed or new_index.keys() != index.keys():
+        try:
+            atomic_write_bytes(index_path, orjson.dumps(new_index, option=orjson.OPT_INDENT_2))
+        except Exception as e:
+            print(f"Error writing library index: {e}")
+
+    books = [{"id": book_id, **row} for book_id, row in new_index.items()]
+    _library_cache[BOOKS_DIR] = (now + LIBRARY_CACHE_TTL, books)
+    return books
 
 @app.get("/", response_class=HTMLResponse)
 async def library_view(request: Request):
     """Lists all available processed books."""
-    books = []
-
-    # Scan directory for folders ending in '_data' that have a book.pkl
-    if os.path.exists(BOOKS_DIR):
-        for item in os.listdir(BOOKS_DIR):
-            item_path = os.path.join(BOOKS_DIR, item)
-            if item.endswith("_data") and os.path.isdir(item_path):
-                # Try to load it to get the title
-                book = load_book_cached(item)
-                if book:
-                    books.append({
-                        "id": item,
-                        "title": book.metadata.title,
-                        "author": ", ".join(book.metadata.authors),
-                        "chapters": len(book.spine)
-                    })
-
+    books = await asyncio.to_thread(load_library_index)
     return templates.TemplateResponse("library.html", {"request": request, "books": books})
 
 @app.get("/read/{book_id}", response_class=HTMLResponse)
 async def redirect_to_first_chapter(request: Request, book_id: str):
     """Helper to just go to chapter 0 OR open PDF."""
-    book = load_book_cached(book_id)
+    book = load_metadata_cached(book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
         
     # Check if it is a PDF
     # We stored "original.pdf" as source_file for PDFs
-    progress = load_progress(book_id)
+    progress = await asyncio.to_thread(load_progress, book_id)
     
     if book.source_file.endswith('.pdf'):
          initial_page = progress.get("page_num", 1)
@@ -287,7 +661,7 @@ async def redirect_to_first_chapter(request: Request, book_id: str):
 @app.get("/read/{book_id}/{chapter_index}", response_class=HTMLResponse)
 async def read_chapter(request: Request, book_id: str, chapter_index: int):
     """The main reader interface."""
-    book = load_book_cached(book_id)
+    book = load_metadata_cached(book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
 
@@ -295,13 +669,16 @@ async def read_chapter(request: Request, book_id: str, chapter_index: int):
         raise HTTPException(status_code=404, detail="Chapter not found")
 
     current_chapter = book.spine[chapter_index]
+    chapter_content = load_chapter_html(book_id, chapter_index)
+    if chapter_content is None:
+        raise HTTPException(status_code=404, detail="Chapter not found")
 
     # Calculate Prev/Next links
     prev_idx = chapter_index - 1 if chapter_index > 0 else None
     next_idx = chapter_index + 1 if chapter_index < len(book.spine) - 1 else None
 
     # Load progress to restore scroll/zoom if applicable
-    progress = load_progress(book_id)
+    progress = await asyncio.to_thread(load_progress, book_id)
     initial_scroll = 0
     # Always restore zoom — it's a per-book preference
     initial_zoom = progress.get("zoom", 100)
@@ -314,6 +691,7 @@ async def read_chapter(request: Request, book_id: str, chapter_index: int):
         "request": request,
         "book": book,
         "current_chapter": current_chapter,
+        "chapter_content": chapter_content,
         "chapter_index": chapter_index,
         "book_id": book_id,
         "prev_idx": prev_idx,
@@ -325,7 +703,7 @@ async def read_chapter(request: Request, book_id: str, chapter_index: int):
 @app.get("/api/chapter/{book_id}/{chapter_index}")
 async def get_chapter_content(book_id: str, chapter_index: int):
     """Returns chapter HTML + navigation metadata as JSON for AJAX navigation."""
-    book = load_book_cached(book_id)
+    book = load_metadata_cached(book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
 
@@ -333,101 +711,105 @@ async def get_chapter_content(book_id: str, chapter_index: int):
         raise HTTPException(status_code=404, detail="Chapter not found")
 
     current_chapter = book.spine[chapter_index]
+    content = load_chapter_html(book_id, chapter_index)
+    if content is None:
+        raise HTTPException(status_code=404, detail="Chapter not found")
     prev_idx = chapter_index - 1 if chapter_index > 0 else None
     next_idx = chapter_index + 1 if chapter_index < len(book.spine) - 1 else None
 
-    return JSONResponse({
-        "content": current_chapter.content,
+    return {
+        "content": content,
         "chapter_index": chapter_index,
         "href": current_chapter.href,
         "prev_idx": prev_idx,
         "next_idx": next_idx,
         "total_chapters": len(book.spine)
-    })
+    }
 
 @app.get("/read/{book_id}/images/{image_name}")
 async def serve_image(book_id: str, image_name: str):
     """
-    Serves images specifically for a book.
-    The HTML contains <img src="images/pic.jpg">.
-    The browser resolves this to /read/{book_id}/images/pic.jpg.
+    Legacy image route. Books imported before image URLs pointed at the
+    /books static mount contain <img src="images/pic.jpg">, which the
+    browser resolves to /read/{book_id}/images/pic.jpg; send it to the mount.
     """
     # Security check: ensure book_id is clean
     safe_book_id = os.path.basename(book_id)
     safe_image_name = os.path.basename(image_name)
-
-    img_path = os.path.join(BOOKS_DIR, safe_book_id, "images", safe_image_name)
-
-    if not os.path.exists(img_path):
-        raise HTTPException(status_code=404, detail="Image not found")
-
-    return FileResponse(img_path)
+    # Permanent, so browsers cache it and skip this handler next time
+    return RedirectResponse(
+        f"/books/{quote(safe_book_id)}/images/{quote(safe_image_name)}", status_code=308
+    )
 
 @app.post("/api/chat")
-async def chat_proxy(payload: dict = Body(...)):
+async def chat_proxy(request: Request, payload: ChatProxyPayload):
     """
     Proxies chat requests to LLM providers to avoid CORS issues.
-    Payload: {
-        "provider": "openai" | "anthropic" | "custom",
-        "apiKey": "sk-...",
-        "baseUrl": "https://...",
-        "model": "gpt-4o",
-        "messages": [...]
-    }
+    The payload is validated once into ChatProxyPayload (see its fields).
     """
-    provider = payload.get("provider")
-    api_key = payload.get("apiKey")
-    base_url = payload.get("baseUrl")
-    model = payload.get("model")
-    messages = payload.get("messages")
-
-    if not provider or not messages:
-        raise HTTPException(status_code=400, detail="Missing provider or messages")
-
+    provider = payload.provider
+    api_key = payload.apiKey
+    base_url = payload.baseUrl
+    model = payload.model
+    messages = payload.messages
+
+    if not messages:
+        raise HTTPException(status_code=400, detail="Missing messages")
+
+    if provider == "openai":
+        url = "https://api.openai.com/v1/chat/completions"
+        headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+        data = {"model": model or "gpt-4o", "messages": messages}
+
+    elif provider == "anthropic":
+        url = "https://api.anthropic.com/v1/messages"
+        headers = {
+            "x-api-key": api_key,
+            "anthropic-version": "2023-06-01",
+            "Content-Type": "application/json"
+        }
+        data = {"model": model or "claude-3-5-sonnet-20240620", "messages": messages, "max_tokens": 1024}
+
+    else:  # custom
+        # For custom, we expect a full URL in baseUrl (e.g. http://localhost:1234/v1/chat/completions)
+        # Let's assume user provides full URL for maximum flexibility
+        if not base_url:
+            raise HTTPException(status_code=400, detail="Custom provider requires baseUrl")
+        url = base_url
+
+        headers = {}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+
+        # Assume OpenAI format for custom
+        data = {"model": model, "messages": messages} if model else {"messages": messages}
+
+    client = request.app.state.http
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            if provider == "openai":
-                url = "https://api.openai.com/v1/chat/completions"
-                headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
-                data = {"model": model or "gpt-4o", "messages": messages}
-                resp = await client.post(url, json=data, headers=headers)
-                resp.raise_for_status()
-                return resp.json()
-
-            elif provider == "anthropic":
-                url = "https://api.anthropic.com/v1/messages"
-                headers = {
-                    "x-api-key": api_key,
-                    "anthropic-version": "2023-06-01",
-                    "Content-Type": "application/json"
-                }
-                data = {"model": model or "claude-3-5-sonnet-20240620", "messages": messages, "max_tokens": 1024}
-                resp = await client.post(url, json=data, headers=headers)
-                resp.raise_for_status()
-                return resp.json()
-
-            elif provider == "custom":
-                # For custom, we expect a full URL in baseUrl (e.g. http://localhost:1234/v1/chat/completions)
-                # Or we can construct it if strictly OpenAI compatible. 
-                # Let's assume user provides full URL for maximum flexibility
-                if not base_url: 
-                     raise HTTPException(status_code=400, detail="Custom provider requires baseUrl")
-                else:
-                    url = "http://localhost:1234/api/chat/completions"
-                
-                heading = {}
-                if api_key:
-                    heading["Authorization"] = f"Bearer {api_key}"
-                
-                # Assume OpenAI format for custom
-                data = {"model": model, "messages": messages} if model else {"messages": messages}
-                resp = await client.post(base_url, json=data, headers=heading)
-                resp.raise_for_status()
-                return resp.json()
-
-            else:
-                raise HTTPException(status_code=400, detail="Unknown provider")
-
+        if payload.stream:
+            data["stream"] = True
+            upstream = await client.send(
+                client.build_request("POST", url, json=data, headers=headers), stream=True
+            )
+            if upstream.is_error:
+                body = (await upstream.aread()).decode("utf-8", errors="replace")
+                await upstream.aclose()
+                print(f"Upstream error: {body}")
+                raise HTTPException(status_code=upstream.status_code, detail=f"Upstream error: {body}")
+            # Relay bytes as they arrive; the upstream response is closed once the stream ends.
+            # aiter_bytes undoes any Content-Encoding, which isn't forwarded to the browser
+            return StreamingResponse(
+                upstream.aiter_bytes(),
+                media_type=upstream.headers.get("content-type", "text/event-stream"),
+                background=BackgroundTask(upstream.aclose)
+            )
+
+        resp = await client.post(url, json=data, headers=headers)
+        resp.raise_for_status()
+        return resp.json()
+
+    except HTTPException:
+        raise
     except httpx.HTTPStatusError as e:
         print(f"Upstream error: {e.response.text}")
         raise HTTPException(status_code=e.response.status_code, detail=f"Upstream error: {e.response.text}")
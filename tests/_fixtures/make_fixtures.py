@@ -0,0 +1,46 @@
+"""
+One-shot generator for the golden test books in this directory.
+Re-run only when the fixtures need to change:
+
+    python tests/_fixtures/make_fixtures.py
+"""
+import os
+
+import fitz # PyMuPDF
+from ebooklib import epub
+
+FIXTURES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_epub(path: str):
+    book = epub.EpubBook()
+    book.set_identifier('id123456')
+    book.set_title('minimal')
+    book.set_language('en')
+    book.add_author('Test Author')
+
+    # Add generic chapter
+    c1 = epub.EpubHtml(title='Intro', file_name='intro.xhtml', lang='en')
+    c1.content = '<h1>Intro</h1><p>Test Content</p>'
+    book.add_item(c1)
+
+    book.toc = (c1,)
+    book.spine = ['nav', c1]
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+
+    epub.write_epub(path, book, {})
+
+
+def make_pdf(path: str):
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((50, 50), "Hello PDF World")
+    doc.save(path, garbage=4, deflate=True)
+    doc.close()
+
+
+if __name__ == "__main__":
+    make_epub(os.path.join(FIXTURES_DIR, "minimal.epub"))
+    make_pdf(os.path.join(FIXTURES_DIR, "minimal.pdf"))
+    print(f"Wrote fixtures to {FIXTURES_DIR}")
@@ -3,19 +3,60 @@ from fastapi.testclient import TestClient
 import sys
 import os
 import shutil
+import hashlib
+import tempfile
+from pathlib import Path
+import orjson
+from functools import cached_property
 from unittest.mock import patch
-import fitz # PyMuPDF
-from ebooklib import epub
+from bs4 import BeautifulSoup
 
 # Add project root to path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from server import app, load_book_cached
-from reader3 import process_epub, process_pdf, save_to_pickle
+from server import app, load_book_cached, load_metadata_cached, flush_pending_progress
+import reader3
+from reader3 import process_epub, process_pdf, save_to_pickle, save_to_msgpack, save_split_layout
 
-@pytest.fixture
+# Golden source books, generated once by tests/_fixtures/make_fixtures.py
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_fixtures")
+FIXTURE_EPUB = os.path.join(FIXTURES_DIR, "minimal.epub")
+FIXTURE_PDF = os.path.join(FIXTURES_DIR, "minimal.pdf")
+
+# lxml's C parser is much faster than html.parser on the full reader templates
+try:
+    import lxml  # noqa: F401
+    _SOUP_FEATURES = "lxml"
+except ImportError:
+    _SOUP_FEATURES = "html.parser"
+
+def pytest_collection_modifyitems(items):
+    """
+    Runs tests grouped by module, in definition order within each module.
+    Reads of the shared session books (rendered pages, load_book_cached)
+    stay back to back instead of interleaving with tests that swap BOOKS_DIR,
+    so don't turn on random ordering without revisiting those fixtures.
+    """
+    # list.sort is stable, so definition order survives within a module
+    items.sort(key=lambda item: item.module.__name__)
+
+class OrjsonTestClient(TestClient):
+    """
+    TestClient whose responses decode .json() with orjson. Only these
+    responses are touched; the server's own httpx calls (e.g. chat_proxy)
+    keep the stock decoder.
+    """
+
+    def request(self, *args, **kwargs):
+        response = super().request(*args, **kwargs)
+        response.json = lambda **kwargs: orjson.loads(response.content)
+        return response
+
+@pytest.fixture(scope="session")
 def client():
-    return TestClient(app)
+    """One TestClient (and one app lifespan) shared by the whole session."""
+    with OrjsonTestClient(app) as c:
+        yield c
 
 @pytest.fixture(scope="function")
 def temp_books_dir(tmp_path):
@@ -28,61 +69,162 @@ def temp_books_dir(tmp_path):
     with patch('server.BOOKS_DIR', str(d)):
         # Clear cache so we don't serve stale data
         load_book_cached.cache_clear()
+        load_metadata_cached.cache_clear()
         yield d
+        # Debounced progress must land in this test's books dir, not the next one's
+        flush_pending_progress()
 
 @pytest.fixture
-def create_test_epub(temp_books_dir):
-    """Generates a valid minimal EPUB and imports it."""
+def fetch_annotations(client):
+    """GETs a book's annotations once and indexes them by id."""
+    def _fetch(book_id):
+        return {a["id"]: a for a in client.get(f"/api/annotations/{book_id}").json()}
+    return _fetch
+
+def _link_or_copy(src, dst):
+    # A hardlink copies no bytes; fall back to a real copy across filesystems
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def _link_tree(src, dst):
+    """
+    Materializes a processed book by hardlinking its files. Safe because the
+    server never rewrites those files in place: new files and os.replace()
+    both get fresh inodes, leaving the template untouched.
+    """
+    shutil.copytree(src, dst, copy_function=_link_or_copy)
+
+def _import_book(src, process, work_dir):
+    """Imports a golden source book into work_dir/minimal_data and returns that path."""
+    src_path = os.path.join(work_dir, os.path.basename(src))
+    _link_or_copy(src, src_path)
+    out_dir = os.path.join(work_dir, "minimal_data")
+    # reader3.process_* return a Book object; saved like the reader3.py CLI does
+    book_obj = process(src_path, out_dir)
+    save_to_pickle(book_obj, out_dir)
+    save_to_msgpack(book_obj, out_dir)
+    save_split_layout(book_obj, out_dir)
+    return out_dir
+
+def _source_digest(src):
+    # The processed tree depends on the fixture, the ingestion code and _import_book
+    h = hashlib.sha256()
+    for path in (src, reader3.__file__, __file__):
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def _warm_template(config, tmp_path_factory, kind, src, process):
+    """
+    Processed _data tree for a golden book, kept in .pytest_cache/d/warm so
+    later runs skip ingestion. The directory name carries the sha256 of the
+    fixture, reader3.py and this file, so changing any of them builds a
+    fresh tree.
+    """
+    if getattr(config, "cache", None) is None:  # -p no:cacheprovider
+        return Path(_import_book(src, process, tmp_path_factory.mktemp(f"{kind}_tpl")))
+
+    warm_dir = config.cache.mkdir("warm")
+    final = warm_dir / f"{kind}_{_source_digest(src)[:16]}"
+    if final.is_dir():
+        return final
+
+    # Build next to the final location and rename it into place, so
+    # concurrent xdist workers only ever see a complete tree
+    work_dir = tempfile.mkdtemp(dir=warm_dir)
+    built = _import_book(src, process, work_dir)
+    try:
+        os.rename(built, final)
+    except OSError:
+        # Another worker got there first; its tree is identical
+        pass
+    shutil.rmtree(work_dir, ignore_errors=True)
+    for stale in warm_dir.glob(f"{kind}_*"):
+        if stale != final:
+            shutil.rmtree(stale, ignore_errors=True)
+    return final
+
+@pytest.fixture(scope="session")
+def _processed_epub_template(pytestconfig, tmp_path_factory):
+    """The golden EPUB imported once (and cached across runs)."""
+    return _warm_template(pytestconfig, tmp_path_factory, "epub", FIXTURE_EPUB, process_epub)
+
+@pytest.fixture(scope="session")
+def _processed_pdf_template(pytestconfig, tmp_path_factory):
+    """The golden PDF imported once (and cached across runs)."""
+    return _warm_template(pytestconfig, tmp_path_factory, "pdf", FIXTURE_PDF, process_pdf)
+
+@pytest.fixture
+def create_test_epub(temp_books_dir, _processed_epub_template):
+    """Imports the golden minimal EPUB under the given name."""
     def _create(name="test_book"):
-        epub_name = f"{name}.epub"
-        epub_path = str(temp_books_dir / epub_name)
-        
-        # Create EPUB
-        book = epub.EpubBook()
-        book.set_identifier('id123456')
-        book.set_title(name)
-        book.set_language('en')
-        book.add_author('Test Author')
-
-        # Add generic chapter
-        c1 = epub.EpubHtml(title='Intro', file_name='intro.xhtml', lang='en')
-        c1.content = '<h1>Intro</h1><p>Test Content</p>'
-        book.add_item(c1)
-        
-        book.toc = (c1,)
-        book.spine = ['nav', c1]
-        book.add_item(epub.EpubNcx())
-        book.add_item(epub.EpubNav())
-
-        epub.write_epub(epub_path, book, {})
-        
-        # Import it (simulating CLI)
-        out_dir = temp_books_dir / f"{name}_data"
-        # reader3.process_epub returns a Book object
-        book_obj = process_epub(epub_path, str(out_dir))
-        save_to_pickle(book_obj, str(out_dir))
-        
+        _link_tree(_processed_epub_template, temp_books_dir / f"{name}_data")
         return f"{name}_data"
     return _create
 
 @pytest.fixture
-def create_test_pdf(temp_books_dir):
-    """Generates a valid minimal PDF and imports it."""
+def create_test_pdf(temp_books_dir, _processed_pdf_template):
+    """Imports the golden minimal PDF under the given name."""
     def _create(name="test_pdf"):
-        pdf_name = f"{name}.pdf"
-        pdf_path = str(temp_books_dir / pdf_name)
-        
-        # Create PDF using PyMuPDF
-        doc = fitz.open()
-        page = doc.new_page()
-        page.insert_text((50, 50), "Hello PDF World")
-        doc.save(pdf_path)
-        doc.close()
-        
-        # Import it
-        out_dir = temp_books_dir / f"{name}_data"
-        book_obj = process_pdf(pdf_path, str(out_dir))
-        save_to_pickle(book_obj, str(out_dir))
-        
+        _link_tree(_processed_pdf_template, temp_books_dir / f"{name}_data")
         return f"{name}_data"
     return _create
+
+# --- Session-wide read-only books ---
+# Template-only tests don't care which book they render, so they share one
+# EPUB and one PDF page rendered once per session. The session books dir is
+# the default BOOKS_DIR for every test (so none touches the real books/);
+# tests that mutate books still get a fresh temp_books_dir on top of it.
+
+@pytest.fixture(autouse=True, scope="session")
+def _session_books_dir(tmp_path_factory, _processed_epub_template, _processed_pdf_template):
+    # tmp_path_factory is already per xdist worker; the name just keeps dirs recognizable
+    d = tmp_path_factory.mktemp(f"books_{os.environ.get('PYTEST_XDIST_WORKER', 'master')}")
+    _link_tree(_processed_epub_template, d / "session_epub_data")
+    _link_tree(_processed_pdf_template, d / "session_pdf_data")
+    # No cache_clear: loaded books stay cached for every read-only test
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr('server.BOOKS_DIR', str(d))
+        yield d
+
+class RenderedPage:
+    """A rendered reader page; element lookups shared by several tests are done once."""
+
+    def __init__(self, book_id, status_code, text):
+        self.book_id = book_id
+        self.status_code = status_code
+        self.text = text
+
+    @cached_property
+    def soup(self):
+        return BeautifulSoup(self.text, _SOUP_FEATURES)
+
+    @cached_property
+    def chat_sidebar(self):
+        return self.soup.find(id="chat-sidebar")
+
+    @cached_property
+    def selection_menu(self):
+        return self.soup.find(id="selection-menu")
+
+    @cached_property
+    def ask_ai_btn(self):
+        if self.selection_menu is None:
+            return None
+        return next((b for b in self.selection_menu.find_all("button") if "Ask AI" in b.get_text()), None)
+
+def _render_page(client, book_id):
+    r = client.get(f"/read/{book_id}")
+    return RenderedPage(book_id, r.status_code, r.text)
+
+@pytest.fixture(scope="session")
+def rendered_epub_page(client, _session_books_dir):
+    """The reader page for a shared EPUB; treat as read-only."""
+    return _render_page(client, "session_epub_data")
+
+@pytest.fixture(scope="session")
+def rendered_pdf_page(client, _session_books_dir):
+    """The reader page for a shared PDF; treat as read-only."""
+    return _render_page(client, "session_pdf_data")
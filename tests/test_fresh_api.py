@@ -1,41 +1,20 @@
 import pytest
-from fastapi.testclient import TestClient
-from server import app
-import os
-import shutil
+import uuid
+from server import load_book_cached
 
 @pytest.fixture
-def client():
-    return TestClient(app)
-
-@pytest.fixture
-def test_book_with_annotations():
-    import uuid
+def test_book_with_annotations(tmp_path, monkeypatch):
     book_id = f"test_book_{uuid.uuid4().hex}"
-    # Use absolute path to ensure no CWD ambiguity
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    project_root = os.path.dirname(base_dir)
-    book_dir = os.path.join(project_root, "books", f"{book_id}_data")
-    
-    # Cleanup before
-    if os.path.exists(book_dir):
-        shutil.rmtree(book_dir)
-    
-    # Ensure it's gone
-    if os.path.exists(book_dir):
-        shutil.rmtree(book_dir) # Try again?
-        
-    os.makedirs(book_dir, exist_ok=True)
-    
+    # tmp_path is removed by pytest, so nothing is written to the project tree
+    book_dir = tmp_path / f"{book_id}_data"
+    book_dir.mkdir()
+
     # Create empty annotations.json
-    with open(os.path.join(book_dir, "annotations.json"), "w") as f:
-        f.write("[]")
-        
+    (book_dir / "annotations.json").write_text("[]")
+
+    monkeypatch.setattr("server.BOOKS_DIR", str(tmp_path))
+    load_book_cached.cache_clear()
     yield book_id
-    
-    # Cleanup after
-    if os.path.exists(book_dir):
-        shutil.rmtree(book_dir)
 
 def test_create_and_get_annotation_with_rects_fresh(client, test_book_with_annotations):
     """
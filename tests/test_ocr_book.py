@@ -0,0 +1,146 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz # PyMuPDF
+
+from tools import ocr_book
+
+PAGES = 4
+
+
+def _make_scanned_pdf(path):
+    """A PDF whose pages are just a full-page image, like a scanned book."""
+    doc = fitz.open()
+    for _ in range(PAGES):
+        page = doc.new_page()
+        scan = fitz.Pixmap(fitz.csGRAY, fitz.IRect(0, 0, 200, 260), 0)
+        scan.clear_with(255)
+        page.insert_image(page.rect, pixmap=scan)
+    doc.save(path)
+    doc.close()
+
+
+def _fake_ocr(skip=()):
+    """Stands in for _ocr_page: a dozen words per page, none for pages in skip."""
+    def _ocr_page(pdf_path, page_index):
+        if page_index in skip:
+            return [], None
+        return [(72 + 40 * n, 100.0, f"word{page_index}_{n}", 10.0, 36.0) for n in range(12)], None
+    return _ocr_page
+
+
+def test_ocr_pdf_saves_each_chunk_incrementally(tmp_path, monkeypatch):
+    """Each chunk is saved incrementally without embedding a font, and the original is kept as .bak."""
+    pdf_path = str(tmp_path / "original.pdf")
+    _make_scanned_pdf(pdf_path)
+    with open(pdf_path, "rb") as f:
+        original = f.read()
+
+    # Threads instead of processes so the stubbed OCR is used by the pool
+    monkeypatch.setattr(ocr_book, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(ocr_book, "ocr_chunk_size", lambda page_count: 2)
+    monkeypatch.setenv("OMP_THREAD_LIMIT", "1")
+
+    saves = []
+    real_save = fitz.Document.save
+    def _spy_save(doc, filename, *args, **kwargs):
+        saves.append(kwargs.get("incremental", False))
+        return real_save(doc, filename, *args, **kwargs)
+    monkeypatch.setattr(fitz.Document, "save", _spy_save)
+
+    # Last page looks like noise on the first run and is left alone
+    monkeypatch.setattr(ocr_book, "_ocr_page", _fake_ocr(skip={PAGES - 1}))
+    ocr_book.ocr_pdf(pdf_path)
+    assert saves == [True, True]  # one incremental save per chunk
+
+    doc = fitz.open(pdf_path)
+    assert not doc.is_repaired
+    assert "word0_0" in doc[0].get_text()
+    assert doc[PAGES - 1].get_text().strip() == ""
+    # Every page references the built-in Helvetica; no font program is embedded
+    fonts = {font[1:4] for page in doc for font in page.get_fonts()}
+    assert fonts == {("n/a", "Type1", "Helvetica")}
+    doc.close()
+
+    backup_path = pdf_path + ".bak"
+    with open(backup_path, "rb") as f:
+        assert f.read() == original
+
+    # A later run only OCRs the remaining page and keeps the first backup
+    monkeypatch.setattr(ocr_book, "_ocr_page", _fake_ocr())
+    ocr_book.ocr_pdf(pdf_path)
+    assert saves == [True, True, True]
+
+    doc = fitz.open(pdf_path)
+    assert f"word{PAGES - 1}_0" in doc[PAGES - 1].get_text()
+    doc.close()
+    with open(backup_path, "rb") as f:
+        assert f.read() == original
+
+    # Three incremental updates on disk, and still no repair needed
+    doc = fitz.open(pdf_path)
+    assert not doc.is_repaired
+    assert doc.can_save_incrementally()
+    doc.close()
+
+
+class _FakeWord:
+    def __init__(self, text, box):
+        self.text = text
+        self.box = box
+
+    def GetUTF8Text(self, level):
+        return self.text
+
+    def BoundingBox(self, level):
+        return self.box
+
+
+class _FakeTessAPI:
+    """Just enough of PyTessBaseAPI for _tesseract_words."""
+    def __init__(self, words):
+        self.words = words
+        self.calls = {}
+
+    def SetImageBytes(self, samples, width, height, n, stride):
+        self.calls["image"] = (width, height, n)
+
+    def SetSourceResolution(self, dpi):
+        self.calls["dpi"] = dpi
+
+    def Recognize(self):
+        pass
+
+    def MeanTextConf(self):
+        return 90
+
+    def GetIterator(self):
+        return self.words
+
+
+def test_tesseract_words_map_pixel_boxes_to_points(tmp_path, monkeypatch):
+    """Pixel boxes from Tesseract become (x, y, text, fontsize, width) runs in PDF points."""
+    pdf_path = str(tmp_path / "original.pdf")
+    _make_scanned_pdf(pdf_path)
+
+    api = _FakeTessAPI([
+        _FakeWord("Hello", (100, 40, 300, 80)),
+        _FakeWord("", (0, 0, 10, 10)),  # empty words are dropped
+        _FakeWord("world", (320, 40, 500, 80)),
+    ])
+    monkeypatch.setattr(ocr_book, "_tess_api", api)
+    monkeypatch.setattr(ocr_book, "RIL", type("RIL", (), {"WORD": 3}), raising=False)
+    monkeypatch.setattr(ocr_book, "iterate_level", lambda it, level: iter(it), raising=False)
+
+    doc = fitz.open(pdf_path)
+    try:
+        # 144 DPI renders two pixels per PDF point
+        words = ocr_book._tesseract_words(doc[0], 144)
+        assert api.calls["image"] == (1190, 1684, 1)  # A4 in gray
+    finally:
+        doc.close()
+
+    assert api.calls["dpi"] == 144
+    assert words == [
+        (50.0, 40.0, "Hello", 20.0, 100.0),
+        (160.0, 40.0, "world", 20.0, 90.0),
+    ]
@@ -1,6 +1,27 @@
+import os
+import gzip
 import json
 import re
+import shutil
+import sqlite3
+import time
+from contextlib import closing
+from unittest.mock import patch
+
+import httpx
+import orjson
 import pytest
+from ebooklib import epub
+
+from reader3 import process_epub, save_to_pickle, save_to_msgpack, save_split_layout
+from server import (
+    app, load_book_cached, load_progress, flush_pending_progress,
+    save_progress_helper, migrate_progress_files, migrate_global_progress
+)
+
+# JSON data blocks embedded by the reader templates
+_READER_JSON_RE = re.compile(r'<script type="application/json" id="reader-data">\s*(\{.*?\})\s*</script>', re.DOTALL)
+_PDF_JSON_RE = re.compile(r'<script type="application/json" id="pdf-data">\s*(\{.*?\})\s*</script>', re.DOTALL)
 
 def test_read_root(client):
     """Verify the root page loads."""
@@ -8,63 +29,62 @@ def test_read_root(client):
     assert response.status_code == 200
     assert "Library" in response.text
 
-def test_read_epub_page_loads(client, create_test_epub):
+def test_read_epub_page_loads(rendered_epub_page):
     """Verify EPUB reader loads and contains valid JSON data block."""
-    book_id = create_test_epub("my_test_epub")
+    book_id = rendered_epub_page.book_id
     
-    response = client.get(f"/read/{book_id}")
+    response = rendered_epub_page
     assert response.status_code == 200
     
     # Check for the data script block
     assert 'id="reader-data"' in response.text, "reader-data block missing"
     
     # Extract and validate JSON
-    match = re.search(r'<script type="application/json" id="reader-data">\s*(\{.*?\})\s*</script>', response.text, re.DOTALL)
+    match = _READER_JSON_RE.search(response.text)
     assert match, "Could not extract reader-data JSON"
     
     data_str = match.group(1)
     try:
-        data = json.loads(data_str)
-    except json.JSONDecodeError as e:
+        data = orjson.loads(data_str)
+    except orjson.JSONDecodeError as e:
         pytest.fail(f"Invalid JSON in reader-data: {e}")
         
     assert data["bookId"] == book_id
     assert "spineMap" in data
     assert isinstance(data["spineMap"], dict)
 
-def test_read_pdf_page_loads(client, create_test_pdf):
+def test_read_pdf_page_loads(rendered_pdf_page):
     """Verify PDF reader loads and contains valid JSON data block."""
-    book_id = create_test_pdf("my_test_pdf")
+    book_id = rendered_pdf_page.book_id
     
-    response = client.get(f"/read/{book_id}")
+    response = rendered_pdf_page
     assert response.status_code == 200
     
     # Check for the data script block
     assert 'id="pdf-data"' in response.text, "pdf-data block missing"
     
     # Extract and validate JSON
-    match = re.search(r'<script type="application/json" id="pdf-data">\s*(\{.*?\})\s*</script>', response.text, re.DOTALL)
+    match = _PDF_JSON_RE.search(response.text)
     assert match, "Could not extract pdf-data JSON"
     
     data_str = match.group(1)
     try:
-        data = json.loads(data_str)
-    except json.JSONDecodeError as e:
+        data = orjson.loads(data_str)
+    except orjson.JSONDecodeError as e:
         pytest.fail(f"Invalid JSON in pdf-data: {e}")
         
     assert data["bookId"] == book_id
     assert "pdfUrl" in data
     assert data["pdfUrl"].endswith(".pdf")
 
-def test_pdf_navigation_script_present(client, create_test_pdf):
+def test_pdf_navigation_script_present(rendered_pdf_page):
     """
     Verify that the frontend JavaScript for scoped arrow key navigation 
     is present in the rendered HTML. 
     Since this is a backend test, we can't execute JS, but we can ensure 
     the template code is being served correctly.
     """
-    book_id = create_test_pdf("nav_test_pdf")
-    response = client.get(f"/read/{book_id}")
+    response = rendered_pdf_page
     assert response.status_code == 200
     
     # Check for the scoped keydown listener on the wrapper
@@ -110,3 +130,323 @@ def test_chat_history_api(client, temp_books_dir):
     # Verify empty again
     resp = client.get(f"/api/chat-history/{book_id}")
     assert resp.json() == []
+
+
+def test_legacy_pickle_book_upgraded_to_msgpack(client, create_test_epub, temp_books_dir):
+    """Books imported with only book.pkl get a book.msgpack and split layout on first load."""
+    book_id = create_test_epub("legacy_pickle_epub")
+    book_dir = temp_books_dir / book_id
+    # Strip the fixture back to what older versions of reader3.py wrote
+    (book_dir / "book.msgpack").unlink()
+    (book_dir / "meta.json").unlink()
+    shutil.rmtree(book_dir / "chapters")
+
+    assert client.get(f"/read/{book_id}").status_code == 200
+    assert (book_dir / "book.msgpack").exists()
+    assert (book_dir / "meta.json").exists()
+    assert (book_dir / "chapters" / "0.html").exists()
+
+    # Without the pickle the book must still load from book.msgpack
+    (book_dir / "book.pkl").unlink()
+    load_book_cached.cache_clear()
+    book = load_book_cached(book_id)
+    assert book is not None
+    assert len(book.spine) >= 1
+
+
+def test_book_cache_revalidates_on_reimport(client, create_test_epub, temp_books_dir):
+    """Cached books are reused until the file on disk changes, then reloaded."""
+    book_id = create_test_epub("book_cache_epub")
+    first = load_book_cached(book_id)
+    assert first is not None
+    assert load_book_cached(book_id) is first
+
+    # Simulate a re-import by bumping the mtime of the stored book
+    msgpack_path = temp_books_dir / book_id / "book.msgpack"
+    st = os.stat(msgpack_path)
+    os.utime(msgpack_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert load_book_cached(book_id) is not first
+
+
+def test_metadata_miss_is_not_cached(client, create_test_epub, temp_books_dir):
+    """A 404 for a book that isn't imported yet doesn't outlive the import."""
+    assert client.get("/read/late_epub_data").status_code == 404
+    book_id = create_test_epub("late_epub")
+    assert client.get(f"/read/{book_id}").status_code == 200
+
+
+def test_reimport_with_longer_spine_is_served(client, create_test_epub, temp_books_dir, tmp_path):
+    """Re-importing a book while the server runs replaces its spine everywhere."""
+    book_id = create_test_epub("reimport_epub")
+    before = client.get(f"/api/chapter/{book_id}/0").json()["total_chapters"]
+
+    book = epub.EpubBook()
+    book.set_identifier('reimport123')
+    book.set_title('minimal')
+    book.set_language('en')
+    chapters = []
+    for n in range(before + 2):
+        c = epub.EpubHtml(title=f'Part {n}', file_name=f'part{n}.xhtml', lang='en')
+        c.content = f'<h1>Part {n}</h1><p>Reimported {n}</p>'
+        book.add_item(c)
+        chapters.append(c)
+    book.toc = tuple(chapters)
+    book.spine = ['nav'] + chapters
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    epub_path = str(tmp_path / "reimport.epub")
+    epub.write_epub(epub_path, book, {})
+
+    # Same steps as the reader3.py CLI
+    out_dir = str(temp_books_dir / book_id)
+    book_obj = process_epub(epub_path, out_dir)
+    save_to_pickle(book_obj, out_dir)
+    save_to_msgpack(book_obj, out_dir)
+    save_split_layout(book_obj, out_dir)
+    after = len(book_obj.spine)
+    assert after > before
+
+    data = client.get(f"/api/chapter/{book_id}/0").json()
+    assert data["total_chapters"] == after
+    last = client.get(f"/api/chapter/{book_id}/{after - 1}")
+    assert last.status_code == 200
+    assert last.json()["next_idx"] is None
+    assert f"Reimported {before + 1}" in last.json()["content"]
+    assert client.get(f"/read/{book_id}/{after - 1}").status_code == 200
+
+
+def test_chapters_served_from_split_layout(client, create_test_epub, temp_books_dir):
+    """Chapter requests only need meta.json + chapters/*.html, as written on import."""
+    book_id = create_test_epub("split_layout_epub")
+    book_dir = temp_books_dir / book_id
+
+    assert client.get(f"/read/{book_id}").status_code == 200
+    assert (book_dir / "meta.json").exists()
+    assert (book_dir / "chapters" / "0.html").exists()
+
+    # The full book is no longer needed for chapter navigation
+    (book_dir / "book.pkl").unlink()
+    (book_dir / "book.msgpack").unlink()
+    resp = client.get(f"/api/chapter/{book_id}/0")
+    assert resp.status_code == 200
+    assert resp.json()["content"] == (book_dir / "chapters" / "0.html").read_text()
+
+
+def test_library_uses_index(client, create_test_epub, temp_books_dir):
+    """The library page lists imported books and records them in books/_index.json."""
+    book_id = create_test_epub("library_index_epub")
+
+    response = client.get("/")
+    assert response.status_code == 200
+    assert f'href="/read/{book_id}"' in response.text
+
+    index = json.loads((temp_books_dir / "_index.json").read_text())
+    assert index[book_id]["title"] == "minimal"
+    assert index[book_id]["chapters"] >= 1
+
+
+def test_chat_proxy_uses_shared_client(client, monkeypatch):
+    """chat_proxy sends through the app-wide pooled client created in the lifespan."""
+    seen = []
+
+    def handler(request):
+        seen.append(str(request.url))
+        return httpx.Response(200, json={"choices": [{"message": {"content": "hi"}}]})
+
+    assert isinstance(app.state.http, httpx.AsyncClient)
+    monkeypatch.setattr(app.state, "http", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    resp = client.post("/api/chat", json={
+        "provider": "custom",
+        "baseUrl": "http://llm.test/v1/chat/completions",
+        "messages": [{"role": "user", "content": "hello"}]
+    })
+
+    assert resp.status_code == 200
+    assert resp.json()["choices"][0]["message"]["content"] == "hi"
+    assert seen == ["http://llm.test/v1/chat/completions"]
+
+
+def test_chat_proxy_streams_upstream(client, monkeypatch):
+    """With stream: true the upstream SSE body is relayed instead of buffered into JSON."""
+    sse = b'data: {"choices": [{"delta": {"content": "hi"}}]}\n\ndata: [DONE]\n\n'
+
+    def handler(request):
+        assert json.loads(request.content)["stream"] is True
+        return httpx.Response(200, stream=httpx.ByteStream(sse), headers={"content-type": "text/event-stream"})
+
+    monkeypatch.setattr(app.state, "http", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    resp = client.post("/api/chat", json={
+        "provider": "custom",
+        "baseUrl": "http://llm.test/v1/chat/completions",
+        "messages": [{"role": "user", "content": "hello"}],
+        "stream": True
+    })
+
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/event-stream")
+    assert resp.content == sse
+
+
+def test_chat_proxy_stream_decodes_compressed_upstream(client, monkeypatch):
+    """A gzip-encoded upstream SSE stream reaches the browser decoded."""
+    sse = b'data: {"choices": [{"delta": {"content": "hi"}}]}\n\ndata: [DONE]\n\n'
+
+    def handler(request):
+        return httpx.Response(200, stream=httpx.ByteStream(gzip.compress(sse)), headers={
+            "content-type": "text/event-stream", "content-encoding": "gzip"
+        })
+
+    monkeypatch.setattr(app.state, "http", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    resp = client.post("/api/chat", json={
+        "provider": "custom",
+        "baseUrl": "http://llm.test/v1/chat/completions",
+        "messages": [{"role": "user", "content": "hello"}],
+        "stream": True
+    })
+
+    assert resp.status_code == 200
+    assert "content-encoding" not in resp.headers
+    assert resp.content == sse
+
+
+def test_chat_history_is_append_only(client, temp_books_dir):
+    """Messages are appended as JSON Lines; a legacy chat_history.json is migrated first."""
+    book_id = "test_book_history_jsonl"
+    book_dir = temp_books_dir / book_id
+    book_dir.mkdir()
+    (book_dir / "chat_history.json").write_text(json.dumps([{"role": "user", "content": "old"}]))
+
+    resp = client.post(f"/api/chat-history/{book_id}", json={"role": "ai", "content": "new"})
+    assert resp.status_code == 200
+
+    lines = (book_dir / "chat_history.jsonl").read_text().splitlines()
+    assert [json.loads(l)["content"] for l in lines] == ["old", "new"]
+    assert [m["content"] for m in client.get(f"/api/chat-history/{book_id}").json()] == ["old", "new"]
+
+
+def test_chat_proxy_rejects_malformed_payload(client):
+    """Payloads are validated by ChatProxyPayload before any upstream call is attempted."""
+    resp = client.post("/api/chat", json={"provider": "bogus", "messages": [{"role": "user", "content": "x"}]})
+    assert resp.status_code == 422
+
+    resp = client.post("/api/chat", json={"provider": "openai", "messages": []})
+    assert resp.status_code == 400
+
+
+def test_progress_stored_in_sqlite(client, temp_books_dir):
+    """Progress round-trips through the per-library progress.db instead of per-book JSON files."""
+    book_id = "test_book_progress"
+    resp = client.post(f"/api/progress/{book_id}", json={"chapter_index": 3, "scroll_position": 120.5})
+    assert resp.status_code == 200
+
+    # Queued snapshot is visible before the debounced write happens
+    assert load_progress(book_id)["chapter_index"] == 3
+    flush_pending_progress()
+    assert load_progress(book_id)["chapter_index"] == 3
+    assert (temp_books_dir / "progress.db").exists()
+    assert not (temp_books_dir / book_id / "progress.json").exists()
+
+
+def test_progress_files_migrated_to_sqlite(temp_books_dir):
+    """Existing per-book progress.json files are imported once and renamed to .bak."""
+    book_dir = temp_books_dir / "old_progress_data"
+    book_dir.mkdir()
+    (book_dir / "progress.json").write_text(json.dumps({"chapter_index": 7}))
+
+    migrate_progress_files()
+
+    assert load_progress("old_progress_data") == {"chapter_index": 7}
+    assert (book_dir / "progress.json.bak").exists()
+
+
+def test_global_progress_file_migrated_in_one_batch(temp_books_dir, tmp_path):
+    """The old global reading_progress.json is imported without clobbering newer rows."""
+    old_file = tmp_path / "reading_progress.json"
+    old_file.write_text(json.dumps({
+        "book_a_data": {"chapter_index": 1},
+        "book_b_data": {"chapter_index": 2},
+    }))
+    save_progress_helper("book_b_data", {"chapter_index": 9})
+
+    with patch("server.OLD_PROGRESS_FILE", str(old_file)):
+        migrate_global_progress()
+
+    assert load_progress("book_a_data") == {"chapter_index": 1}
+    assert load_progress("book_b_data") == {"chapter_index": 9}
+    assert not old_file.exists()
+    assert (tmp_path / "reading_progress.json.bak").exists()
+
+
+def _stored_progress(books_dir, book_id):
+    """Reads a book's row straight from progress.db, bypassing the pending queue."""
+    db_path = books_dir / "progress.db"
+    if not db_path.exists():
+        return None
+    with closing(sqlite3.connect(db_path)) as conn:
+        try:
+            row = conn.execute("SELECT data FROM progress WHERE book_id = ?", (book_id,)).fetchone()
+        except sqlite3.OperationalError:  # table not created yet
+            return None
+    return orjson.loads(row[0]) if row else None
+
+
+def test_progress_writes_are_debounced(client, temp_books_dir):
+    """A burst of progress updates for one book collapses into a single queued snapshot."""
+    book_id = "test_book_debounce"
+    for i in range(5):
+        resp = client.post(f"/api/progress/{book_id}", json={"chapter_index": i})
+        assert resp.json() == {"status": "queued"}
+
+    assert app.state.pending_progress[book_id]["chapter_index"] == 4
+    assert load_progress(book_id)["chapter_index"] == 4
+    assert _stored_progress(temp_books_dir, book_id) is None
+
+    flush_pending_progress()
+    assert book_id not in app.state.pending_progress
+    assert _stored_progress(temp_books_dir, book_id)["chapter_index"] == 4
+
+
+def test_progress_timer_flushes_to_db(client, temp_books_dir, monkeypatch):
+    """The scheduled flush writes the snapshot, then drops it from the queue."""
+    monkeypatch.setattr("server.PROGRESS_FLUSH_DELAY", 0.01)
+    book_id = "test_book_timer_flush"
+    client.post(f"/api/progress/{book_id}", json={"chapter_index": 2})
+
+    deadline = time.monotonic() + 5
+    while book_id in app.state.pending_progress and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert book_id not in app.state.pending_progress
+    assert book_id not in app.state.progress_timers
+    assert _stored_progress(temp_books_dir, book_id)["chapter_index"] == 2
+    assert load_progress(book_id)["chapter_index"] == 2
+
+
+def test_epub_images_point_at_static_mount(tmp_path):
+    """Ingestion rewrites <img> sources to the /books static mount."""
+    book = epub.EpubBook()
+    book.set_identifier('img123')
+    book.set_title('Images')
+    book.set_language('en')
+    img = epub.EpubImage(uid='pic', file_name='images/pic 1.png', media_type='image/png', content=b'\x89PNG')
+    book.add_item(img)
+    c1 = epub.EpubHtml(title='Intro', file_name='intro.xhtml', lang='en')
+    c1.content = '<h1>Intro</h1><p><img src="images/pic%201.png"/></p>'
+    book.add_item(c1)
+    book.toc = (c1,)
+    book.spine = ['nav', c1]
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    epub_path = str(tmp_path / "images.epub")
+    epub.write_epub(epub_path, book, {})
+
+    out_dir = tmp_path / "images_data"
+    book_obj = process_epub(epub_path, str(out_dir))
+    assert 'src="/books/images_data/images/pic1.png"' in book_obj.spine[-1].content
+    assert (out_dir / "images" / "pic1.png").exists()
+
+
+def test_legacy_image_route_redirects(client):
+    """Relative image links from older imports are redirected to the static mount."""
+    resp = client.get("/read/old_book_data/images/pic.jpg", follow_redirects=False)
+    assert resp.status_code == 308
+    assert resp.headers["location"] == "/books/old_book_data/images/pic.jpg"
@@ -1,7 +1,55 @@
+import re
 import pytest
-from bs4 import BeautifulSoup
 
-def test_regression_sidebar_css_fix(client, create_test_epub):
+# These only inspect rendered templates; tracing them under coverage costs a lot and measures little
+pytestmark = pytest.mark.no_cover
+
+_RIGHT_SIDEBAR_RE = re.compile(r'#right-sidebar\s*{([^}]*)}')
+
+def _missing_tokens(text, tokens):
+    """Returns the tokens absent from text, found with one alternation scan instead of one `in` per token."""
+    # Longest first so a token that prefixes another can't shadow it at the same position
+    pat = re.compile("|".join(map(re.escape, sorted(tokens, key=len, reverse=True))))
+    found = {m.group(0) for m in pat.finditer(text)}
+    return {t: msg for t, msg in tokens.items() if t not in found}
+
+def _at_least(text, minimums):
+    """
+    True once every token has occurred its minimum number of times;
+    stops scanning at that point instead of counting to the end.
+    """
+    remaining = {t: k for t, k in minimums.items() if k > 0}
+    pat = re.compile("|".join(map(re.escape, sorted(minimums, key=len, reverse=True))))
+    for m in pat.finditer(text):
+        if not remaining:
+            break
+        token = m.group(0)
+        if token in remaining:
+            remaining[token] -= 1
+            if not remaining[token]:
+                del remaining[token]
+    return not remaining
+
+REQUIRED_PDF_ANNOTATION_TOKENS = {
+    "window.updateAnnotationContent = updateAnnotationContent": "PDF: updateAnnotationContent must be exposed",
+    "window.reloadAnnotations = loadAnnotations": "PDF: reloadAnnotations must be exposed for delete refresh",
+    "highlight-layer": "PDF: highlights use dedicated overlay layer for zoom scaling",
+    "visiblePages": "PDF: annotations list must be per-page (visible pages filter)",
+    "visibleAnns": "PDF: annotations list must be per-page (visible pages filter)",
+}
+
+REQUIRED_EPUB_ANNOTATION_TOKENS = {
+    "window.reloadAnnotations = loadAnnotations": "EPUB: reloadAnnotations must be set for delete refresh",
+    "currentAnnotations": "EPUB: currentAnnotations used for edit/delete",
+    "activateHighlight": "EPUB: activateHighlight should use loadChapter when different chapter",
+    "loadChapter": "EPUB: activateHighlight should use loadChapter when different chapter",
+    "ann-edit-btn": "EPUB: edit/delete use data-id buttons to allow edit-again",
+    "ann-delete-btn": "EPUB: edit/delete use data-id buttons to allow edit-again",
+    "chapterAnns": "EPUB: annotations list must be per-section (current chapter only)",
+    "chapter_index === chapterIndex": "EPUB: annotations list must be per-section (current chapter only)",
+}
+
+def test_regression_sidebar_css_fix(rendered_epub_page):
     """
     Step Id: 312
     User reported that sidebar resizing was broken/blocked.
@@ -14,24 +62,14 @@ def test_regression_sidebar_css_fix(client, create_test_epub):
     2. #chat-sidebar does NOT have a resize handle div (id="resize-handle").
     """
     
-    book_id = create_test_epub("test_book_ui")
-    
-    # Use the correct route /read/{book_id}
-    response = client.get(f"/read/{book_id}")
-    assert response.status_code == 200
-    
-    soup = BeautifulSoup(response.text, 'html.parser')
+    assert rendered_epub_page.status_code == 200
+    soup = rendered_epub_page.soup
     
     # 1. Check for position: relative in #right-sidebar CSS
     # Note: Styles are likely in a <style> block in components/right_sidebar.html
     # We search all style blocks.
-    style_content = ""
-    for style in soup.find_all('style'):
-        if style.string:
-            style_content += style.string
-            
     # Normalize whitespace for check
-    style_content = " ".join(style_content.split())
+    style_content = " ".join(" ".join(s.string.split()) for s in soup.find_all('style') if s.string)
     
     # We expect strict checking for #right-sidebar { ... position: relative
     # But string matching is brittle. Let's check if the specific rule exists.
@@ -48,34 +86,28 @@ def test_regression_sidebar_css_fix(client, create_test_epub):
     # #right-sidebar { ... position: relative; ... }
     # We can just check that 'position: relative' is present in the CSS for #right-sidebar
     # Extract the block for #right-sidebar
-    import re
-    match = re.search(r'#right-sidebar\s*{([^}]*)}', style_content)
+    match = _RIGHT_SIDEBAR_RE.search(style_content)
     assert match is not None, "Could not find #right-sidebar CSS rule"
     css_props = match.group(1)
     
     assert "position: relative" in css_props, "Regression: #right-sidebar missing 'position: relative'"
 
 
-def test_regression_chat_component_cleanup(client, create_test_epub):
+def test_regression_chat_component_cleanup(rendered_epub_page):
     """
     Verifies that the Chat Component no longer has the conflicting resize handle.
     """
-    book_id = create_test_epub("test_book_ui_2")
-
-    response = client.get(f"/read/{book_id}")
-    assert response.status_code == 200
-    
-    soup = BeautifulSoup(response.text, 'html.parser')
+    assert rendered_epub_page.status_code == 200
     
     # The chat sidebar id is 'chat-sidebar'
-    chat_sidebar = soup.find(id='chat-sidebar')
+    chat_sidebar = rendered_epub_page.chat_sidebar
     assert chat_sidebar is not None
     
     # Did we successfully remove the resize-handle?
     resize_handle = chat_sidebar.find(id='resize-handle')
     assert resize_handle is None, "Regression: Conflicting 'resize-handle' found inside Chat Component"
 
-def test_regression_ask_ai_context_wiring(client, create_test_epub):
+def test_regression_ask_ai_context_wiring(rendered_epub_page):
     """
     Step Id: 387
     User requested: 'Ask AI' should open Global Chat with a cancellable context box,
@@ -85,27 +117,16 @@ def test_regression_ask_ai_context_wiring(client, create_test_epub):
     1. right_sidebar.html contains 'openGlobalChat' method.
     2. reader.html 'Ask AI' button calls 'triggerAskAI' (not triggerAnnotation).
     """
-    book_id = create_test_epub("test_book_ai_wiring")
-    response = client.get(f"/read/{book_id}")
-    assert response.status_code == 200
-    
-    text = response.text
+    assert rendered_epub_page.status_code == 200
+    text = rendered_epub_page.text
     
     # 1. Check for openGlobalChat definition in the JS
     assert "openGlobalChat:" in text, "RightSidebar missing openGlobalChat method"
     
     # 2. Check for Ask AI button wiring
-    soup = BeautifulSoup(text, 'html.parser')
-    selection_menu = soup.find(id="selection-menu")
-    assert selection_menu is not None
+    assert rendered_epub_page.selection_menu is not None
     
-    buttons = selection_menu.find_all("button")
-    ask_btn = None
-    for btn in buttons:
-        if "Ask AI" in btn.text:
-            ask_btn = btn
-            break
-            
+    ask_btn = rendered_epub_page.ask_ai_btn
     assert ask_btn is not None, "Ask AI button not found"
     onclick = ask_btn.get("onclick", "")
     assert "triggerAskAI()" in onclick, "Ask AI button should call triggerAskAI()"
@@ -114,109 +135,96 @@ def test_regression_ask_ai_context_wiring(client, create_test_epub):
     assert "triggerAnnotation('ask')" not in onclick, "Ask AI button should NOT call triggerAnnotation('ask')"
 
 
-def test_regression_pdf_highlight_wiring(client, create_test_pdf):
+def test_regression_pdf_highlight_wiring(rendered_pdf_page):
     """
     Step Id: 470
     User reported: Highlights didn't scale/persist on PDF zoom/resize.
     renderHighlights() must be called after render completes (so highlights scale with zoom).
     """
-    book_id = create_test_pdf("test_book_pdf_scaling")
-    response = client.get(f"/read/{book_id}")
-    assert response.status_code == 200
-    text = response.text
+    assert rendered_pdf_page.status_code == 200
+    text = rendered_pdf_page.text
     assert "function renderHighlights()" in text
-    count = text.count("renderHighlights()")
-    assert count >= 3, "renderHighlights() should be called in loadAnnotations and after render (single + dual)"
-    # After render we call it inside requestAnimationFrame in the promise .then()
-    assert "requestAnimationFrame" in text and "renderHighlights()" in text, "renderHighlights() must run after layout (e.g. in requestAnimationFrame after render)"
+    # Called in loadAnnotations and after render (single + dual); after render we
+    # call it inside requestAnimationFrame in the promise .then()
+    assert _at_least(text, {"renderHighlights()": 3, "requestAnimationFrame": 1}), \
+        "renderHighlights() must be called >= 3 times, after layout (e.g. in requestAnimationFrame after render)"
+
+
+# Step Id: 511
+# User requested:
+# 1. Remove 'Note' button from selection menu.
+# 2. Remove 'Thread' tab from sidebar.
+# 3. PDF highlights normalized to [0,1].
+
+@pytest.mark.parametrize("page_fixture, label", [
+    ("rendered_epub_page", "EPUB"),
+    ("rendered_pdf_page", "PDF"),
+])
+def test_regression_note_button_removed(page_fixture, label, request):
+    """'Note' button is NOT present in reader.html and pdf_reader.html."""
+    page = request.getfixturevalue(page_fixture)
+    assert 'onclick="triggerAnnotation(\'note\')"' not in page.text, f"{label}: 'Note' button wasn't removed"
+
+
+def test_regression_thread_tab_removed(rendered_epub_page):
+    """'Thread' tab is NOT present in right_sidebar.html (via rendered page)."""
+    # The tab button id was 'tab-btn-thread'
+    assert 'id="tab-btn-thread"' not in rendered_epub_page.text, "Sidebar: Thread tab button should be removed"
+    assert 'id="tab-thread"' not in rendered_epub_page.text, "Sidebar: Thread tab content div should be removed"
 
 
-def test_regression_ui_simplification(client, create_test_epub, create_test_pdf):
-    """
-    Step Id: 511
-    User requested: 
-    1. Remove 'Note' button from selection menu.
-    2. Remove 'Thread' tab from sidebar.
-    3. PDF highlights normalized to [0,1].
-    
-    This test verifies:
-    1. 'Note' button is NOT present in reader.html and pdf_reader.html.
-    2. 'Thread' tab is NOT present in right_sidebar.html (via rendered page).
-    3. pdf_reader.html contains logic for normalization (heuristic).
-    """
-    
-    # 1. EPUB check
-    book_id = create_test_epub("test_book_ui_simple")
-    resp_epub = client.get(f"/read/{book_id}")
-    assert 'onclick="triggerAnnotation(\'note\')"' not in resp_epub.text, "EPUB: 'Note' button wasn't removed"
-    
-    # 2. PDF check
-    pdf_id = create_test_pdf("test_book_ui_simple_pdf")
-    resp_pdf = client.get(f"/read/{pdf_id}")
-    assert 'onclick="triggerAnnotation(\'note\')"' not in resp_pdf.text, "PDF: 'Note' button wasn't removed"
-    
-    # 3. Sidebar check (Thread tab removal)
-    # The tab button id was 'tab-btn-thread'
-    assert 'id="tab-btn-thread"' not in resp_epub.text, "Sidebar: Thread tab button should be removed"
-    assert 'id="tab-thread"' not in resp_epub.text, "Sidebar: Thread tab content div should be removed"
-    
-    # 4. PDF Normalization check (Multi-rect support & Styling)
+def test_regression_pdf_highlight_normalization(rendered_pdf_page):
+    """pdf_reader.html renders normalized multi-rect highlights as pink underlines."""
+    text = rendered_pdf_page.text
     # The new logic iterates over `rects` and uses `r[0]`, `r[1]`, etc.
     # We check for the loop or the new variable usage.
-    assert "rects.forEach(r => {" in resp_pdf.text or "div.style.left = (r[0] * 100) + '%'" in resp_pdf.text, "PDF: Render logic should use percentages with multi-rect support"
-    
-    # 5. Styling Check (Pink Underline)
+    assert "rects.forEach(r => {" in text or "div.style.left = (r[0] * 100) + '%'" in text, "PDF: Render logic should use percentages with multi-rect support"
+
+    # Styling Check (Pink Underline)
     # Ensure background is transparent and border is pink (or borderBottom is set)
-    assert "div.style.background = 'transparent'" in resp_pdf.text or "div.style.background='transparent'" in resp_pdf.text, "PDF: Highlight background should be transparent"
-    assert "div.style.borderBottom" in resp_pdf.text and "#ff69b4" in resp_pdf.text, "PDF: Highlight should use pink underline (#ff69b4)"
+    assert "div.style.background = 'transparent'" in text or "div.style.background='transparent'" in text, "PDF: Highlight background should be transparent"
+    assert "div.style.borderBottom" in text and "#ff69b4" in text, "PDF: Highlight should use pink underline (#ff69b4)"
 
 
-def test_regression_pdf_annotation_edit_delete_and_scale(client, create_test_pdf):
+def test_regression_pdf_annotation_edit_delete_and_scale(rendered_pdf_page):
     """
     Regression: PDF annotations tab edit/delete and highlight scaling.
     - PDF reader must define updateAnnotationContent and reloadAnnotations so edit/delete work.
     - Highlights use dedicated .highlight-layer overlay (same coordinate system as selection) for correct scaling.
     - Annotations list is per-page (visiblePages / dual-page aware).
     """
-    book_id = create_test_pdf("test_pdf_ann")
-    resp = client.get(f"/read/{book_id}")
+    resp = rendered_pdf_page
     assert resp.status_code == 200
     text = resp.text
-    assert "window.updateAnnotationContent = updateAnnotationContent" in text, "PDF: updateAnnotationContent must be exposed"
-    assert "window.reloadAnnotations = loadAnnotations" in text, "PDF: reloadAnnotations must be exposed for delete refresh"
-    assert "highlight-layer" in text, "PDF: highlights use dedicated overlay layer for zoom scaling"
-    assert "visiblePages" in text and "visibleAnns" in text, "PDF: annotations list must be per-page (visible pages filter)"
+    missing = _missing_tokens(text, REQUIRED_PDF_ANNOTATION_TOKENS)
+    assert not missing, missing
 
 
-def test_regression_sidebar_delete_reloads_annotations(client, create_test_epub):
+def test_regression_sidebar_delete_reloads_annotations(rendered_epub_page):
     """
     Regression: After deleting an annotation, UI must reload from server (reloadAnnotations).
     """
-    resp = client.get(f"/read/{create_test_epub('test_sidebar_reload')}")
+    resp = rendered_epub_page
     assert resp.status_code == 200
     assert "window.reloadAnnotations" in resp.text, "Sidebar or reader must use reloadAnnotations"
     assert "reloadAnnotations()" in resp.text or "reloadAnnotations();" in resp.text, "reloadAnnotations must be invoked after delete"
 
 
-def test_regression_epub_annotation_navigate_and_reload(client, create_test_epub):
+def test_regression_epub_annotation_navigate_and_reload(rendered_epub_page):
     """
     Regression: EPUB annotations - reloadAnnotations, activateHighlight with chapter navigation.
     - Annotations list is per-section (chapterAnns filter by chapterIndex).
     - Multi-node highlight support (findRangeForQuote) so highlights across elements are visible.
     """
-    book_id = create_test_epub("test_epub_ann")
-    resp = client.get(f"/read/{book_id}")
+    resp = rendered_epub_page
     assert resp.status_code == 200
     text = resp.text
-    assert "window.reloadAnnotations = loadAnnotations" in text, "EPUB: reloadAnnotations must be set for delete refresh"
-    assert "currentAnnotations" in text, "EPUB: currentAnnotations used for edit/delete"
-    assert "activateHighlight" in text and "loadChapter" in text, "EPUB: activateHighlight should use loadChapter when different chapter"
-    assert "ann-edit-btn" in text and "ann-delete-btn" in text, "EPUB: edit/delete use data-id buttons to allow edit-again"
-    assert "chapterAnns" in text and "chapter_index === chapterIndex" in text, "EPUB: annotations list must be per-section (current chapter only)"
+    missing = _missing_tokens(text, REQUIRED_EPUB_ANNOTATION_TOKENS)
+    assert not missing, missing
     assert "findRangeForQuote" in text or "extractContents" in text, "EPUB: multi-node range for highlight visibility across elements"
 
 
-def test_regression_chat_history_format_parsing(client, create_test_epub):
+def test_regression_chat_history_format_parsing(rendered_epub_page):
     """
     Step Id: 54
     User requested: Chat history should include quoted text in a foldable format.
@@ -228,9 +236,8 @@ def test_regression_chat_history_format_parsing(client, create_test_epub):
     2. The JS logic creates a `details` element.
     3. The JS logic creates a `summary` element.
     """
-    book_id = create_test_epub("test_chat_format")
     # Chat component is included in read page
-    resp = client.get(f"/read/{book_id}")
+    resp = rendered_epub_page
     assert resp.status_code == 200
     text = resp.text
     
@@ -247,19 +254,16 @@ def test_regression_chat_history_format_parsing(client, create_test_epub):
     assert 'window.handleHighlightFromChat' in text, "Chat component missing handleHighlightFromChat call"
 
 
-def test_mobile_touch_selection_support(client, create_test_epub, create_test_pdf):
+def test_mobile_touch_selection_support(rendered_epub_page, rendered_pdf_page):
     """
     Verifies that both EPUB and PDF readers support touch-device text selection.
     On touch devices (pointer: coarse), a persistent header action bar replaces
     the floating popup (which conflicts with the iOS native selection toolbar).
     """
-    epub_id = create_test_epub("test_touch_epub")
-    pdf_id = create_test_pdf("test_touch_pdf")
-
-    resp_epub = client.get(f"/read/{epub_id}")
+    resp_epub = rendered_epub_page
     assert resp_epub.status_code == 200
 
-    resp_pdf = client.get(f"/read/{pdf_id}")
+    resp_pdf = rendered_pdf_page
     assert resp_pdf.status_code == 200
 
     for label, text in [("EPUB", resp_epub.text), ("PDF", resp_pdf.text)]:
@@ -280,7 +284,7 @@ def test_mobile_touch_selection_support(client, create_test_epub, create_test_pd
         "PDF: computePdfSelectionState helper must exist for shared mouseup/selectionchange logic"
 
 
-def test_mobile_viewport_dvh_fix(client, create_test_epub, create_test_pdf):
+def test_mobile_viewport_dvh_fix(rendered_epub_page, rendered_pdf_page):
     """
     Both readers use 100dvh (dynamic viewport height) so the layout fits the
     actual visible area on iOS/Android when browser chrome (address/toolbar) is shown.
@@ -288,11 +292,8 @@ def test_mobile_viewport_dvh_fix(client, create_test_epub, create_test_pdf):
     viewport-fit=cover is required so the layout is not inset from the screen
     edges on devices with notches / Face ID.
     """
-    epub_id = create_test_epub("test_dvh_epub")
-    pdf_id = create_test_pdf("test_dvh_pdf")
-
-    for label, book_id in [("EPUB", epub_id), ("PDF", pdf_id)]:
-        text = client.get(f"/read/{book_id}").text
+    for label, page in [("EPUB", rendered_epub_page), ("PDF", rendered_pdf_page)]:
+        text = page.text
         assert '100dvh' in text, \
             f"{label}: must use 100dvh for dynamic viewport height on mobile"
         assert '100vh' in text, \
@@ -301,7 +302,7 @@ def test_mobile_viewport_dvh_fix(client, create_test_epub, create_test_pdf):
             f"{label}: viewport-fit=cover required for safe-area handling on notched devices"
 
 
-def test_epub_touch_quote_caching(client, create_test_epub):
+def test_epub_touch_quote_caching(rendered_epub_page):
     """
     On iOS, tapping a button clears the text selection before the JS onclick
     handler runs.  The EPUB reader caches the selected quote in currentEpubQuote
@@ -312,8 +313,7 @@ def test_epub_touch_quote_caching(client, create_test_epub):
     same as the PDF pattern) instead of contains(), which is more robust for the
     anchor nodes that iOS produces.
     """
-    book_id = create_test_epub("test_epub_quote_cache")
-    text = client.get(f"/read/{book_id}").text
+    text = rendered_epub_page.text
 
     # Cache variable declared
     assert 'currentEpubQuote' in text, \
@@ -332,7 +332,7 @@ def test_epub_touch_quote_caching(client, create_test_epub):
         "EPUB: triggerAskAI must fall back to currentEpubQuote if selection was cleared by tap"
 
 
-def test_epub_highlight_immediate_feedback(client, create_test_epub):
+def test_epub_highlight_immediate_feedback(rendered_epub_page):
     """
     After creating a highlight annotation the sidebar should open to the
     annotations list immediately (same UX as notes and PDF).
@@ -343,8 +343,7 @@ def test_epub_highlight_immediate_feedback(client, create_test_epub):
     Also verifies that clicking an existing highlight span opens the sidebar
     to that specific annotation (openThread), not just the generic open().
     """
-    book_id = create_test_epub("test_epub_hl_feedback")
-    text = client.get(f"/read/{book_id}").text
+    text = rendered_epub_page.text
 
     # After creating a highlight, openThread is called (not skipped like before)
     assert "type === 'note' || type === 'highlight'" in text, \
@@ -1,11 +1,173 @@
 import fitz
 import os
 import sys
-import glob
+import argparse
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-def ocr_pdf(pdf_path):
+# Optional: a long-lived Tesseract engine per worker (pip install tesserocr).
+# Without it we fall back to PyMuPDF's one-shot get_textpage_ocr.
+try:
+    from tesserocr import PyTessBaseAPI, PSM, RIL, iterate_level
+except ImportError:
+    PyTessBaseAPI = None
+
+_tess_api = None
+
+# Below these, a page's OCR output is treated as noise (e.g. a blank scan)
+# and no text layer is written for it
+MIN_OCR_WORDS = 10
+MIN_OCR_CONFIDENCE = 40
+
+# Rasterization range for OCR: never above the old fixed 150 DPI, and the
+# floor only guards against degenerate image sizes
+MIN_OCR_DPI = 72
+MAX_OCR_DPI = 150
+
+def needs_ocr(page):
+    # Cheapest signal first: get_images() only walks the Resources dict, and a
+    # page without images has nothing to OCR however little text it has
+    if not page.get_images():
+        return False
+    # flags=0 is the cheapest extraction mode
+    text = page.get_text("text", flags=0)
+    # Threshold: if less than 50 chars, assume it's a scanned page (or blank);
+    # only strip when the raw length doesn't already decide it
+    return len(text) < 50 or len(text.strip()) < 50
+
+def ocr_dpi(page):
+    """
+    Picks a rasterization DPI that matches the page's scan: the largest image
+    by area is the scan (small ones are logos or ornaments). Low-resolution
+    scans aren't upsampled past their native DPI, and nothing goes above
+    MAX_OCR_DPI.
+    """
+    try:
+        # get_images() rows are (xref, smask, width, height, ...)
+        xref, _, width, _, *_ = max(page.get_images(), key=lambda img: img[2] * img[3])
+        rects = page.get_image_rects(xref)
+        shown_width = rects[0].width if rects else page.rect.width
+        dpi = int(72 * width / shown_width)
+    except Exception:
+        return MAX_OCR_DPI
+    return max(MIN_OCR_DPI, min(dpi, MAX_OCR_DPI))
+
+def _tesseract_words(page, dpi):
+    """
+    OCRs a page with this process's shared PyTessBaseAPI, so the model is
+    loaded once per worker instead of once per page. Returns one
+    (x, y, text, fontsize, width) run per word.
+    """
+    global _tess_api
+    if _tess_api is None:
+        _tess_api = PyTessBaseAPI(lang="eng", psm=PSM.AUTO)
+
+    # Tesseract binarizes anyway; a gray pixmap is a third of the RGB bytes
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+    _tess_api.SetImageBytes(pix.samples, pix.width, pix.height, pix.n, pix.stride)
+    # Raw bytes carry no DPI; without it Tesseract assumes 70 and misjudges text size
+    _tess_api.SetSourceResolution(dpi)
+    _tess_api.Recognize()
+    if _tess_api.MeanTextConf() < MIN_OCR_CONFIDENCE:
+        return []
+
+    # Map pixmap pixels back to PDF points
+    scale = 72 / dpi
+    words = []
+    for it in iterate_level(_tess_api.GetIterator(), RIL.WORD):
+        text = it.GetUTF8Text(RIL.WORD)
+        box = it.BoundingBox(RIL.WORD)
+        if not text or not box:
+            continue
+        x0, y0, x1, y1 = box
+        # Bottom-left of the box as the insertion point, box height as font size
+        words.append((x0 * scale, y1 * scale, text, (y1 - y0) * scale, (x1 - x0) * scale))
+    return words
+
+def _ocr_page(pdf_path, page_index):
+    """
+    Process-pool worker: OCRs one page of its own copy of the document.
+    Returns (runs, error) so one bad page doesn't abort the others; runs are
+    (x, y, text, fontsize, width) tuples, one per word, empty when the result
+    looks like noise.
+    """
+    try:
+        doc = fitz.open(pdf_path)
+        try:
+            page = doc[page_index]
+            dpi = ocr_dpi(page)
+            if PyTessBaseAPI is not None:
+                words = _tesseract_words(page, dpi)
+                return (words if len(words) >= MIN_OCR_WORDS else []), None
+            # full=True enables full page analysis
+            tp = page.get_textpage_ocr(flags=3, language="eng", dpi=dpi, full=True)
+            # One run per word box, placed at its own bottom-left: laying a whole
+            # span out in Helvetica from the span origin drifts off the scan
+            words = [(x0, y1, text, y1 - y0, x1 - x0)
+                     for x0, y0, x1, y1, text, *_ in tp.extractWORDS()]
+            return (words if len(words) >= MIN_OCR_WORDS else []), None
+        finally:
+            doc.close()
+    except Exception as e:
+        return None, str(e)
+
+def ocr_chunk_size(page_count):
+    """
+    Pages to OCR between saves. Small books are done in one pass; big ones
+    are saved and reopened every chunk, so MuPDF only keeps one chunk's
+    edited pages in memory and an interrupted run keeps what it has done.
+    """
+    if page_count <= 200:
+        return page_count
+    if page_count <= 1000:
+        return 50
+    return 25
+
+def _save_ocr(doc, pdf_path):
+    """
+    Writes the new text layer back to pdf_path, closes doc and returns a
+    freshly opened one. The reopen also matters for correctness: saving the
+    same open document incrementally twice makes MuPDF write a stale xref
+    offset, and the file then needs repair on the next open.
+    """
+    # Keep a pristine copy once; later saves append to the already-OCR'd file
+    backup_path = pdf_path + ".bak"
+    need_backup = not os.path.exists(backup_path)
+
+    if doc.can_save_incrementally():
+        # An incremental save writes into the original file (same inode), so
+        # the backup has to be a real copy rather than a hardlink
+        if need_backup:
+            shutil.copy(pdf_path, backup_path)
+            print(f"Backed up original to {backup_path}")
+        # Only the new text objects and an xref delta are appended;
+        # the original image streams are left untouched on disk
+        print(f"Saving to {pdf_path} (incremental)...")
+        doc.save(pdf_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+        doc.close()
+    else:
+        # Repaired/damaged files can't take an incremental update
+        output_path = pdf_path.replace(".pdf", "_ocr.pdf")
+        print(f"Saving to {output_path} (full rewrite)...")
+        doc.save(output_path)
+        doc.close()
+        if need_backup:
+            # The original inode survives the replace below, so a hardlink
+            # backs it up without copying any data
+            try:
+                os.link(pdf_path, backup_path)
+            except OSError:
+                shutil.copy(pdf_path, backup_path)
+            print(f"Backed up original to {backup_path}")
+        # Atomic swap, also when pdf_path exists on Windows
+        os.replace(output_path, pdf_path)
+    return fitz.open(pdf_path)
+
+def ocr_pdf(pdf_path, workers=None):
     """
     Scans a PDF and adds a text layer to pages that are missing it using OCR.
+    Pages are OCR'd in parallel worker processes; the text is written back here.
     """
     print(f"Processing: {pdf_path}")
     
@@ -15,134 +177,112 @@ def ocr_pdf(pdf_path):
         print(f"Error opening PDF: {e}")
         return
 
+    todo = [i for i, page in enumerate(doc) if needs_ocr(page)]
+    if not todo:
+        print("No pages needed OCR.")
+        doc.close()
+        return
+
+    print(f"{len(todo)} page(s) need OCR, running...")
+    # Each worker runs Tesseract single-threaded, so processes don't fight over
+    # OpenMP threads; the pool itself provides the parallelism
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    workers = min(workers or os.cpu_count() or 1, len(todo))
+    chunk_size = ocr_chunk_size(len(doc))
+
     modified = False
-    
-    # Create a temporary output path
-    output_path = pdf_path.replace(".pdf", "_ocr.pdf")
-    
-    for i, page in enumerate(doc):
-        # Check if page has text
-        text = page.get_text()
-        # Threshold: if less than 50 chars, assume it's a scanned page (or blank)
-        # We can also check for images to be sure it's not just a blank page
-        has_images = len(page.get_images()) > 0
-        
-        if len(text.strip()) < 50 and has_images:
-            print(f"Page {i+1}: undetected text ({len(text.strip())} chars), running OCR...", end="", flush=True)
-            
-            try:
-                # full=True enables full page analysis
-                # textpage = page.get_textpage_ocr(flags=3, language="eng", dpi=300, full=True)
-                # We need to insert the text back into the page. 
-                # Actually fitz doesn't support *modifying* the page in-place with OCR easily in one step 
-                # to add a text layer *over* the image without re-drawing
-                # BUT, we can use a pdfwriter or just use the highly convenient:
-                # page.insert_pdf(src_doc, ...) ?? No.
-                
-                # Correct approach with PyMuPDF 1.20+:
-                # Use a partial PDF from OCR and overlay it?
-                # Or rely on `page.get_textpage_ocr()` just getting us the text, 
-                # but to *save* it we need to insert it.
-                
-                # Wait, looking at PyMuPDF docs, `get_textpage_ocr` creates a TextPage.
-                # To add the text to the PDF, we effectively need to overlay invisible text.
-                # There isn't a one-line "convert this page to OCR'd page" method in core fitz 
-                # exactly like `ocrmypdf`.
-                
-                # However, since v1.19.0, we can do this pattern:
-                # 1. Get OCR text page
-                # 2. Insert the text invisible over the mage?
-                # Actually, `page.pdf_insert_text` isn't a thing.
-                
-                # Let's use the standard recipe for "OCR a page and replace it":
-                # We can't easily "replace" the page content in-place with its OCR'd version 
-                # without losing the original image quality unless we are careful.
-                
-                # SIMPLER APPROACH:
-                # generate a new PDF page from the OCR result (image + text) and replace the old page?
-                # No, that might re-compress images.
-                
-                # CORRECT APPROACH for "Adding Text Layer":
-                # Only insert invisible text. 
-                # PyMuPDF doesn't have high-level "insert invisible text from OCR" method.
-                # But we can iterate over the text blocks from OCR and insert them using `page.insert_text`.
-                
-                # Let's try to get the text blocks and write them invisible.
-                tp = page.get_textpage_ocr(flags=3, language="eng", dpi=150, full=True)
-                
-                # Now we iterate blocks and write them
-                # render_mode=3 is 'invisible'
-                # extractWORDS returns list of (x0, y0, x1, y1, "word", block_no, line_no, word_no)
-                words = tp.extractWORDS()
-                
-                for w in words:
-                    # x0, y0, x1, y1, text, block, line, word
-                    x0, y0, x1, y1, text, block, line, word = w
-                    
-                    # Create rect
-                    rect = fitz.Rect(x0, y0, x1, y1)
-                    
-                    # Estimate fontsize (height of word box)
-                    fontsize = y1 - y0
-                    # Tesseract sometimes gives tight boxes, maybe scale slightly? 
-                    # Actually fontsize usually matches height well.
-                    
-                    # Insert text invisible
-                    # We use the bottom-left coordinate for insertion
-                    page.insert_text((x0, y1), text, fontsize=fontsize, render_mode=3)
-                                
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        for start in range(0, len(todo), chunk_size):
+            chunk = todo[start:start + chunk_size]
+            changed = False
+            for i, (runs, error) in zip(chunk, ex.map(partial(_ocr_page, pdf_path), chunk)):
+                if error is not None:
+                    print(f"Page {i+1}: OCR failed: {error}")
+                    continue
+                if not runs:
+                    print(f"Page {i+1}: Skipped (likely blank).")
+                    continue
+
+                page = doc[i]
+                # Add the OCR words as an invisible text layer over the scanned image,
+                # batched in one Shape: one content stream per page. "helv" is the
+                # built-in Helvetica, referenced by name rather than embedded.
+                shape = page.new_shape()
+
+                for x, y, text, fontsize, width in runs:
+                    # Shrink words Helvetica sets wider than the scan, so they
+                    # don't run into the next word (extraction would merge them)
+                    natural = fitz.get_text_length(text, fontname="helv", fontsize=fontsize)
+                    if natural > width > 0:
+                        fontsize *= width / natural
+                    # render_mode=3 is 'invisible'
+                    shape.insert_text((x, y), text, fontname="helv", fontsize=fontsize, render_mode=3)
+
+                shape.commit()
+
+                changed = True
+                print(f"Page {i+1}: Done ({len(runs)} words).")
+
+            if changed:
+                # Workers for the next chunk open pdf_path, so it must be
+                # saved before they start
+                doc = _save_ocr(doc, pdf_path)
                 modified = True
-                print(f" Done ({len(words)} words).")
-                
-            except Exception as e:
-                print(f" Failed: {e}")
-        else:
-            # print(f"Page {i+1}: has text or no images, skipping.")
-            pass
 
+    doc.close()
     if modified:
-        print(f"Saving to {output_path} (fast)...")
-        # Faster save: no garbage collection, no deflate
-        doc.save(output_path)
-        
-        # Backup original and replace
-        backup_path = pdf_path + ".bak"
-        if not os.path.exists(backup_path):
-            os.rename(pdf_path, backup_path)
-            print(f"Backed up original to {backup_path}")
-        
-        os.rename(output_path, pdf_path)
-        print(f"Replaced original with OCR'd version.")
+        print(f"Updated {pdf_path} with OCR text layer.")
     else:
-        print("No pages needed OCR.")
-        doc.close()
+        print("No pages were OCR'd successfully.")
+
+def find_pdfs(target):
+    """
+    Resolves a book directory, PDF path, book id or fuzzy name to PDFs.
+    """
+    # If target has "books/", strictly use it
+    if "books/" in target:
+        return [os.path.join(target, "original.pdf") if os.path.isdir(target) else target]
+    # Case 1: Full path to PDF
+    if target.endswith(".pdf") and os.path.exists(target):
+        return [target]
+    # Case 2: Book ID or directory name in books/
+    # Check exact match first
+    possible_path = os.path.join("books", target, "original.pdf")
+    if os.path.exists(possible_path):
+        return [possible_path]
+    # Substring search over one directory read; d_type lets is_dir() skip
+    # files without a stat, and only matching names are checked for a PDF
+    if not os.path.isdir("books"):
+        return []
+    found = []
+    with os.scandir("books") as it:
+        for entry in it:
+            if target in entry.name and entry.is_dir():
+                pdf_path = os.path.join(entry.path, "original.pdf")
+                if os.path.exists(pdf_path):
+                    found.append(pdf_path)
+    return sorted(found)
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        target = sys.argv[1]
-        
-        # If target has "books/", strictly use it
-        if "books/" in target:
-             pdf_path = os.path.join(target, "original.pdf") if os.path.isdir(target) else target
-             ocr_pdf(pdf_path)
-        else:
-            # Case 1: Full path to PDF
-            if target.endswith(".pdf") and os.path.exists(target):
-                ocr_pdf(target)
-            else:
-                # Case 2: Book ID or directory name in books/
-                # Check exact match first
-                possible_path = os.path.join("books", target, "original.pdf")
-                if os.path.exists(possible_path):
-                     ocr_pdf(possible_path)
-                else:
-                    # Glob search
-                    search_pattern = os.path.join("books", f"*{target}*", "original.pdf")
-                    found = glob.glob(search_pattern)
-                    if found:
-                        for p in found:
-                            ocr_pdf(p)
-                    else:
-                        print(f"Could not find book matching '{target}'")
+    parser = argparse.ArgumentParser(description="Add an OCR text layer to scanned PDF pages.")
+    parser.add_argument("target", help="book directory, PDF path, or (partial) book name")
+    parser.add_argument("--jobs", type=int, default=max(1, (os.cpu_count() or 1) // 4),
+                        help="books to OCR concurrently (default: cpu_count // 4)")
+    args = parser.parse_args()
+
+    found = find_pdfs(args.target)
+    if not found:
+        print(f"Could not find book matching '{args.target}'")
+        sys.exit(1)
+
+    # Set before any pool starts so every Tesseract process inherits it
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    jobs = max(1, min(args.jobs, len(found)))
+    if jobs == 1:
+        for p in found:
+            ocr_pdf(p)
     else:
-        print("Usage: python tools/ocr_book.py <book_directory_or_pdf>")
+        # Split the cores between concurrent books and their page workers
+        per_book = max(1, (os.cpu_count() or 1) // jobs)
+        with ProcessPoolExecutor(max_workers=jobs) as ex:
+            list(ex.map(partial(ocr_pdf, workers=per_book), found))